@@ -1,87 +1,423 @@
-import sys
-import json
+import asyncio
 import os
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from uuid import uuid4
-from core.amqp.base.provider import AMQPProvider
-from core.amqp.model.payload import AMQPMethod, AMQPPayload, AMQPBody, AMQPStatus, AMQPResponse
-from services.fernet_service import FernetService
+from core.amqp.base.log import get_logger, truncate
+from core.amqp.base.instrumentation import ERRORS_TOTAL, HEADER_SENT_AT, HEADER_TRACE_ID, IN_FLIGHT, STAGE_SECONDS, get_instrumentation
+from core.amqp.base.cipher import AMQPPayloadCipher, HEADER_ACCEPT_ENCODING, SUPPORTED_ENCODINGS, decompress
+from core.amqp.base.provider import HEADER_DEADLINE, HEADER_NO_REPLY, AMQPProvider
+from core.amqp.base.producer import AMQPProducer
+from core.amqp.base.stream import HEADER_STREAM_ACCEPT, HEADER_STREAM_FIELD, HEADER_STREAM_LAST, HEADER_STREAM_QUEUE, HEADER_STREAM_SEQ, STREAM_CHUNK_SIZE, STREAM_CONTENT_FIELD, AMQPStreamReceiver, iter_chunks, stream_headers, stream_queue, stream_queue_arguments
+from core.amqp.model.payload import AMQPMethod, AMQPPayload, AMQPBody, AMQPStatus, AMQPResponse, BATCH_METHODS
+from core.amqp.result_cache import INVALIDATING_METHODS, AMQPResultCache
+
+logger = get_logger(__name__)
+
+# Secondi di attesa di default per la risposta del microservizio
+DEFAULT_TIMEOUT = 60
+
+class AMQPDeferredResponse:
+    """
+    Risposta di una richiesta inviata con AMQPService.connect_and_get_deferred.
+
+    Il thread che ha inviato la richiesta è subito libero: la risposta può essere interrogata con done(),
+    attesa con result() oppure con await da un event loop asyncio.
+    """
+
+    def __init__(self, amqp_method: AMQPMethod, reply: Future):
+        self.amqp_method = amqp_method
+        self.__reply = reply
+
+    def done(self) -> bool:
+        return self.__reply.done()
+
+    def result(self, timeout: float = DEFAULT_TIMEOUT) -> AMQPResponse:
+        """
+        :param timeout: Secondi massimi di attesa; allo scadere la risposta può essere richiesta di nuovo.
+        :return: Risposta del microservizio, oppure una risposta ERROR come in connect_and_get_data.
+        """
+        try:
+            try:
+                response = AMQPResponse.from_bytes(self.__reply.result(timeout=timeout))
+            except FutureTimeoutError:
+                raise Exception("Timeout")
+
+            if response.status == AMQPStatus.ERROR:
+                raise Exception(response.to_json())
+
+            return response
+
+        except Exception as e:
+            get_instrumentation().increment(ERRORS_TOTAL, side="client", stage="call", method=self.amqp_method.value)
+            return AMQPResponse(self.amqp_method, AMQPStatus.ERROR, str(e))
+
+    def __await__(self):
+        return self.__wait().__await__()
+
+    async def __wait(self) -> AMQPResponse:
+        try:
+            await asyncio.wrap_future(self.__reply)
+        except Exception:
+            # L'errore viene convertito in risposta ERROR da result
+            pass
+        return self.result(timeout=0)
 
 
 class AMQPService:
-    def __init__(self, amqp_provider: AMQPProvider):
+    def __init__(self, amqp_provider: AMQPProvider, compression: str = None, result_cache: AMQPResultCache = None):
+        """
+        :param compression: Compressione applicata alle richieste prima della cifratura ("zlib" o "zstd"), None per disattivarla.
+        :param result_cache: Cache locale delle risposte READ_FILE, invalidata dalle SAVE_FILE e DELETE_FILE di questo client in tutte le modalità di invio.
+        """
         self.amqp_provider = amqp_provider
+        self.compression = compression
+        self.result_cache = result_cache
 
-    def connect_and_get_data(self, amqp_method: AMQPMethod, **kwargs):
+    def connect_and_get_data(self, amqp_method: AMQPMethod, timeout: float = DEFAULT_TIMEOUT, **kwargs):
         """
         Connette e ottiene i dati da un microservizio tramite RabbitMQ.
 
         :param amqp_method: Metodo AMQP da invocare.
+        :param timeout: Secondi massimi di attesa della risposta.
         :param kwargs: Parametri da passare al metodo AMQP.
         :return: Risposta ottenuta dal microservizio.
         """
         try:
             payload = AMQPPayload(amqp_method, AMQPBody(**kwargs))
-            response = self.__send_data(payload, self.amqp_provider)
+
+            # Le scritture invalidano la cache in __publish_request, comune a tutte le modalità di invio
+            cache_key = self.result_cache.key(payload.body) if self.result_cache is not None and amqp_method == AMQPMethod.READ_FILE else None
+            if cache_key is not None:
+                cached = self.result_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+                generation = self.result_cache.begin()
+
+            response = self.__send_data(payload, self.amqp_provider, timeout)
 
             if response.status == AMQPStatus.ERROR:
                 raise Exception(response.to_json())
 
+            if cache_key is not None:
+                self.result_cache.put(cache_key, response, generation)
             return response
 
         except Exception as e:
+            get_instrumentation().increment(ERRORS_TOTAL, side="client", stage="call", method=amqp_method.value)
             return AMQPResponse(amqp_method, AMQPStatus.ERROR, str(e))
 
-    def __send_data(self, payload: AMQPPayload, amqp: AMQPProvider):
+    def connect_and_send(self, amqp_method: AMQPMethod, timeout: float = DEFAULT_TIMEOUT, **kwargs) -> AMQPResponse:
+        """
+        Invia una richiesta senza attendere la risposta del microservizio, che non la pubblica.
+        Adatto a SEND_EMAIL e SEND_NOTIFICATION quando basta sapere che il messaggio è stato accettato dal broker.
+
+        :param amqp_method: Metodo AMQP da invocare.
+        :param timeout: Secondi massimi di attesa della publish.
+        :param kwargs: Parametri da passare al metodo AMQP.
+        :return: Risposta OK se il messaggio è stato consegnato al broker, ERROR altrimenti.
+        """
+        try:
+            payload = AMQPPayload(amqp_method, AMQPBody(**kwargs))
+            uuid, published = self.__publish_request(payload, self.amqp_provider, no_reply=True)
+            if isinstance(published, Future):
+                published.result(timeout=timeout)
+
+            return AMQPResponse(amqp_method, AMQPStatus.OK, uuid)
+
+        except Exception as e:
+            get_instrumentation().increment(ERRORS_TOTAL, side="client", stage="call", method=amqp_method.value)
+            return AMQPResponse(amqp_method, AMQPStatus.ERROR, str(e))
+
+    def connect_and_get_deferred(self, amqp_method: AMQPMethod, **kwargs) -> "AMQPDeferredResponse":
+        """
+        Invia una richiesta e restituisce subito un riferimento alla risposta, da interrogare o attendere in seguito.
+        Se la risposta non viene letta, la richiesta scade dal registro dopo PENDING_TTL secondi.
+
+        :param amqp_method: Metodo AMQP da invocare.
+        :param kwargs: Parametri da passare al metodo AMQP.
+        """
+        reply = Future()
+        try:
+            payload = AMQPPayload(amqp_method, AMQPBody(**kwargs))
+            # Una risposta non letta scade dal registro dopo il suo TTL: oltre non serve eseguire la richiesta
+            _, reply = self.__publish_request(payload, self.amqp_provider, timeout=self.amqp_provider.pending_replies.ttl)
+        except Exception as e:
+            reply.set_exception(e)
+
+        return AMQPDeferredResponse(amqp_method, reply)
+
+    def connect_and_get_many(self, amqp_method: AMQPMethod, items: list, timeout: float = DEFAULT_TIMEOUT) -> list:
+        """
+        Invia più richieste dello stesso metodo in un unico messaggio.
+
+        :param amqp_method: Metodo AMQP da invocare per ogni elemento (vedi BATCH_METHODS).
+        :param items: Lista di dizionari, ognuno con i parametri di una singola richiesta.
+        :param timeout: Secondi massimi di attesa della risposta.
+        :return: Lista di risposte, nello stesso ordine degli elementi.
+        """
+        try:
+            if amqp_method not in BATCH_METHODS:
+                raise Exception(f"Il metodo {amqp_method.value} non supporta l'invio in batch")
+
+            bodies = [AMQPBody(**item).__dict__ for item in items]
+            payload = AMQPPayload(AMQPMethod.BATCH, AMQPBody(method=amqp_method.value, items=bodies))
+            response = self.__send_data(payload, self.amqp_provider, timeout)
+
+            if response.status == AMQPStatus.ERROR:
+                raise Exception(response.to_json())
+
+            return [
+                AMQPResponse(AMQPMethod(item["method"]), AMQPStatus(item["status"]), item["data"])
+                for item in response.data
+            ]
+
+        except Exception as e:
+            return [AMQPResponse(amqp_method, AMQPStatus.ERROR, str(e)) for _ in items]
+
+    def stream_save_file(self, file_settings: dict, chunks, content_field: str = STREAM_CONTENT_FIELD, chunk_size: int = STREAM_CHUNK_SIZE, timeout: float = DEFAULT_TIMEOUT) -> AMQPResponse:
+        """
+        Salva un file inviandone il contenuto in chunk cifrati singolarmente, senza caricarlo tutto in memoria.
+
+        :param file_settings: Impostazioni del file, senza il contenuto.
+        :param chunks: Contenuto del file: bytes, file aperto in binario o iterabile di bytes.
+        :param content_field: Campo di file_settings in cui il microservizio inserisce il contenuto.
+        :param chunk_size: Dimensione massima in byte di ciascun chunk.
+        :param timeout: Secondi massimi di attesa della risposta dopo l'ultimo chunk.
+        :return: Risposta ottenuta dal microservizio.
+        """
+        try:
+            amqp = self.amqp_provider
+            cipher = AMQPPayloadCipher.for_key(os.environ.get("BBSENDER_ENCRYPT_KEY"))
+            method = AMQPMethod.SAVE_FILE.value
+            uuid = str(uuid4())
+            origin = os.environ.get("BBSENDER_ORIGIN")
+
+            cache_key = self.result_cache.key(AMQPBody(file_settings=file_settings)) if self.result_cache is not None else None
+            if cache_key is not None:
+                self.result_cache.invalidate(cache_key)
+
+            reply = amqp.pending_replies.register(uuid)
+            try:
+                # I chunk viaggiano su una coda dedicata allo stream, letta solo dal consumer che riceve il chunk 0:
+                # con più processi o repliche sulla coda delle richieste lo stream non viene diviso tra consumer diversi
+                queue = stream_queue(amqp.producer_queue, uuid)
+                sender = AMQPProducer(queue=queue, routing_key=queue + "_rk", queue_arguments=stream_queue_arguments())
+                sender.start_messanger()
+                try:
+                    def send_chunk(seq: int, data, last: bool):
+                        encrypted_data, _ = cipher.encrypt(data)
+                        # Publish sincrone: il contenuto in attesa resta nel broker, non nella memoria del processo
+                        sender.publish(method, uuid, encrypted_data, {"headers": stream_headers(seq, last)})
+                        # La risposta è attesa dalla fine dell'upload: uno stream lungo non deve farla scadere nel registro
+                        if not amqp.pending_replies.touch(uuid):
+                            raise Exception("Richiesta scartata dal registro delle risposte")
+
+                    logger.debug("Streaming data to %s with uuid %s", method, uuid)
+                    # Il chunk 0 contiene le impostazioni e la coda dello stream, i successivi il contenuto del file, l'ultimo è vuoto
+                    encrypted_data, _ = cipher.encrypt(AMQPBody(file_settings=file_settings).to_bytes())
+                    headers = stream_headers(0, False, {HEADER_STREAM_FIELD: content_field, HEADER_STREAM_QUEUE: sender.queue})
+                    published = amqp.publish(origin, method, encrypted_data, corr_id=uuid, properties={"headers": headers})
+                    if isinstance(published, Future):
+                        published.result(timeout=timeout)
+
+                    seq = 1
+                    for chunk in iter_chunks(chunks, chunk_size):
+                        send_chunk(seq, chunk, False)
+                        seq += 1
+                    send_chunk(seq, b"", True)
+                finally:
+                    sender.close_connection()
+
+                response = self.__parse_response(self.__wait_for_response(reply, uuid, method, timeout))
+            finally:
+                amqp.pending_replies.discard(uuid)
+                if cache_key is not None:
+                    self.result_cache.invalidate(cache_key)
+
+            if response.status == AMQPStatus.ERROR:
+                raise Exception(response.to_json())
+
+            return response
+
+        except Exception as e:
+            return AMQPResponse(AMQPMethod.SAVE_FILE, AMQPStatus.ERROR, str(e))
+
+    def stream_read_file(self, file_settings: dict, content_field: str = STREAM_CONTENT_FIELD, chunk_size: int = STREAM_CHUNK_SIZE, timeout: float = DEFAULT_TIMEOUT):
+        """
+        Legge un file ricevendone il contenuto in chunk cifrati singolarmente.
+
+        I chunk arrivano su una coda dedicata allo stream, con una propria connessione: il broker
+        consegna al più STREAM_WINDOW chunk non ancora letti, quindi la memoria resta costante
+        anche se il generatore viene consumato più lentamente di quanto il microservizio legga il file.
+
+        :param file_settings: Impostazioni del file da leggere.
+        :param content_field: Campo della risposta che contiene il contenuto, se il worker non supporta lo streaming.
+        :param chunk_size: Dimensione massima in byte di ciascun chunk.
+        :param timeout: Secondi massimi di attesa tra un chunk e il successivo.
+        :return: Generatore dei bytes del file; solleva un'eccezione in caso di errore o di stream interrotto.
+        """
+        amqp = self.amqp_provider
+        cipher = AMQPPayloadCipher.for_key(os.environ.get("BBSENDER_ENCRYPT_KEY"))
+        method = AMQPMethod.READ_FILE.value
+        uuid = str(uuid4())
+        origin = os.environ.get("BBSENDER_ORIGIN")
+
+        encrypted_data, content_encoding = cipher.encrypt(AMQPBody(file_settings=file_settings).to_bytes(), self.compression)
+
+        # La coda dello stream è dichiarata prima della richiesta, così nessun chunk va perso
+        receiver = AMQPStreamReceiver(stream_queue(amqp.consumer_queue, uuid))
+        receiver.start_messanger()
+        try:
+            properties = {
+                "content_encoding": content_encoding,
+                "headers": {HEADER_STREAM_ACCEPT: chunk_size, HEADER_STREAM_FIELD: content_field, HEADER_STREAM_QUEUE: receiver.queue}
+            }
+
+            logger.debug("Requesting stream from %s with uuid %s", method, uuid)
+            published = amqp.publish(origin, method, encrypted_data, corr_id=uuid, properties=properties)
+            if isinstance(published, Future):
+                published.result(timeout=timeout)
+
+            expected_seq = 0
+            for props, body in receiver.receive(timeout):
+                headers = props.headers or {}
+                if HEADER_STREAM_SEQ not in headers:
+                    # Il microservizio risponde senza stream solo in caso di errore
+                    raise Exception(self.__parse_response(decompress(body, props.content_encoding)).to_json())
+
+                seq = headers[HEADER_STREAM_SEQ]
+                if seq != expected_seq:
+                    raise Exception(f"Stream interrotto: atteso il chunk {expected_seq}, ricevuto {seq}")
+                expected_seq += 1
+
+                data = cipher.decrypt(body)
+                if data:
+                    yield data
+                if headers.get(HEADER_STREAM_LAST):
+                    return
+        finally:
+            receiver.close()
+
+    def __send_data(self, payload: AMQPPayload, amqp: AMQPProvider, timeout: float):
         """
         Invia dati crittografati a un microservizio tramite RabbitMQ e attende la risposta.
 
         :param payload: Payload AMQP da inviare al microservizio.
         :param amqp: Provider AMQP utilizzato per comunicare con il microservizio.
+        :param timeout: Secondi massimi di attesa della risposta.
         :return: Risposta ottenuta dal microservizio.
         """
         method = payload.method.value
-        data = payload.body.to_json() if payload.body else None
+        instrumentation = get_instrumentation()
+
+        with instrumentation.in_flight(IN_FLIGHT, side="client", method=method):
+            uuid, reply = self.__publish_request(payload, amqp, timeout=timeout)
+            try:
+                with instrumentation.timer(STAGE_SECONDS, stage="wait", method=method):
+                    response = self.__wait_for_response(reply, uuid, method, timeout)
+            finally:
+                amqp.pending_replies.discard(uuid)
+        
+        logger.debug("Response for %s with uuid %s is %s", method, uuid, truncate(response))
+
+        return self.__parse_response(response)
+
+    def __publish_request(self, payload: AMQPPayload, amqp: AMQPProvider, no_reply: bool = False, timeout: float = None):
+        """
+        Cifra e pubblica una richiesta.
+
+        :param no_reply: Se True il microservizio non invia la risposta e nessun Future viene registrato.
+        :param timeout: Secondi di attesa del chiamante: la richiesta scade in coda e viene scartata dal microservizio dopo questo tempo.
+        :return: Coppia (uuid, Future); il Future è quello della risposta, oppure quello della publish se no_reply.
+        """
+        method = payload.method.value
+        data = payload.body.to_bytes() if payload.body else None
+        instrumentation = get_instrumentation()
+
+        # SAVE_FILE e DELETE_FILE invalidano la cache locale prima della publish e di nuovo alla risposta:
+        # una lettura eseguita nel frattempo non salva il contenuto precedente. Senza risposta la scrittura
+        # può terminare dopo una nuova lettura, che resta in cache al più per il ttl
+        cache_key = None
+        if self.result_cache is not None and payload.method in INVALIDATING_METHODS:
+            cache_key = self.result_cache.key(payload.body)
+        if cache_key is not None:
+            self.result_cache.invalidate(cache_key)
 
-        encrypt_key = os.environ.get("BBSENDER_ENCRYPT_KEY")
-                
-        encrypted_data = FernetService.encrypt_data(data, encrypt_key)
+        with instrumentation.timer(STAGE_SECONDS, stage="encrypt", method=method):
+            cipher = AMQPPayloadCipher.for_key(os.environ.get("BBSENDER_ENCRYPT_KEY"))
+            encrypted_data, content_encoding = cipher.encrypt(data, self.compression)
         uuid = str(uuid4())
+        origin = os.environ.get("BBSENDER_ORIGIN")
+        sent_at = time.time()
 
-        print(f"Sending data to {method} with uuid {uuid}", file=sys.stderr)
-        amqp.publish(method, encrypted_data, corr_id=uuid)
+        # Il microservizio può comprimere la risposta con una delle codifiche accettate
+        # Il corr_id viaggia anche come identificativo di traccia, con l'istante di invio per misurare l'attesa in coda
+        properties = {
+            "content_encoding": content_encoding,
+            "headers": {
+                HEADER_ACCEPT_ENCODING: ",".join(SUPPORTED_ENCODINGS),
+                HEADER_TRACE_ID: uuid,
+                HEADER_SENT_AT: sent_at
+            }
+        }
 
-        response = self.__wait_for_response(amqp, uuid, method)
-        
-        response_dict = json.loads(response)
-        
-        print(f"Response for {method} with uuid {uuid} is {response_dict}", file=sys.stderr)
+        if timeout is not None:
+            # Il broker elimina il messaggio rimasto in coda oltre il timeout (expiration in millisecondi),
+            # il microservizio scarta quello consegnato dopo la scadenza senza decifrarlo
+            properties["expiration"] = str(max(1, int(timeout * 1000)))
+            properties["headers"][HEADER_DEADLINE] = sent_at + timeout
+
+        if no_reply:
+            properties["headers"][HEADER_NO_REPLY] = 1
+            logger.debug("Sending data to %s with uuid %s, no reply", method, uuid)
+            with instrumentation.timer(STAGE_SECONDS, stage="publish", method=method):
+                published = amqp.publish(origin, method, encrypted_data, corr_id=uuid, properties=properties)
+            return uuid, published
+
+        # Il Future va registrato prima della publish, altrimenti una risposta veloce andrebbe persa
+        reply = amqp.pending_replies.register(uuid)
+        try:
+            logger.debug("Sending data to %s with uuid %s", method, uuid)
+            with instrumentation.timer(STAGE_SECONDS, stage="publish", method=method):
+                published = amqp.publish(origin, method, encrypted_data, corr_id=uuid, properties=properties)
+        except Exception:
+            amqp.pending_replies.discard(uuid)
+            raise
+
+        if cache_key is not None:
+            # Eseguita anche se la risposta fallisce o il chiamante smette di attendere
+            reply.add_done_callback(lambda _: self.result_cache.invalidate(cache_key))
+
+        if isinstance(published, Future):
+            # Producer pipelined: un errore di publish sveglia subito il chiamante invece di attendere il timeout
+            published.add_done_callback(
+                lambda future: future.exception() is not None and amqp.pending_replies.fail(uuid, future.exception())
+            )
+        return uuid, reply
 
-        return AMQPResponse(AMQPMethod(response_dict["method"]), AMQPStatus(response_dict["status"]), response_dict["data"])
+    def __parse_response(self, response: bytes) -> AMQPResponse:
+        return AMQPResponse.from_bytes(response)
 
-    def __wait_for_response(self, amqp, uuid, method):
+    def __wait_for_response(self, reply: Future, uuid, method, timeout: float):
         """
         Attende la risposta da un microservizio tramite RabbitMQ.
 
-        :param amqp: Provider AMQP utilizzato per comunicare con il microservizio.
+        :param reply: Future completato dal provider all'arrivo della risposta.
         :param uuid: UUID utilizzato per identificare univocamente la richiesta.
         :param method: Metodo AMQP invocato.
+        :param timeout: Secondi massimi di attesa della risposta.
         :return: Risposta ottenuta dal microservizio.
         """
-        print(f"Waiting for response for {method} with uuid {uuid}", file=sys.stderr)
-        start_time = time.time()
-        
-        timeout_time = start_time + 60
-        
-        while True:
-            if uuid in amqp.response_dict:
-                response = amqp.response_dict.pop(uuid)
-                print(f"Response found for {method} with uuid {uuid}", file=sys.stderr)
-                break
-            elif time.time() > timeout_time:
-                print(f"Timeout for {method} with uuid {uuid}", file=sys.stderr)
-                raise Exception("Timeout")
-            time.sleep(0.1)
+        logger.debug("Waiting for response for %s with uuid %s", method, uuid)
+
+        try:
+            response = reply.result(timeout=timeout)
+        except FutureTimeoutError:
+            logger.warning("Timeout for %s with uuid %s", method, uuid)
+            raise Exception("Timeout")
+
+        logger.debug("Response found for %s with uuid %s", method, uuid)
 
         if isinstance(response, Exception):
             raise response
@@ -0,0 +1,73 @@
+import os
+import asyncio
+from uuid import uuid4
+from core.amqp.base.async_provider import AsyncAMQPProvider
+from core.amqp.base.cipher import AMQPPayloadCipher
+from core.amqp.base.log import get_logger
+from core.amqp.model.payload import AMQPMethod, AMQPPayload, AMQPBody, AMQPStatus, AMQPResponse
+
+logger = get_logger(__name__)
+
+# Secondi di attesa di default per la risposta del microservizio
+DEFAULT_TIMEOUT = 60
+
+
+class AsyncAMQPService:
+    def __init__(self, amqp_provider: AsyncAMQPProvider):
+        self.amqp_provider = amqp_provider
+
+    async def call(self, amqp_method: AMQPMethod, timeout: float = DEFAULT_TIMEOUT, **kwargs) -> AMQPResponse:
+        """
+        Invoca un metodo del microservizio e attende la risposta senza bloccare l'event loop.
+
+        :param amqp_method: Metodo AMQP da invocare.
+        :param timeout: Secondi massimi di attesa della risposta.
+        :param kwargs: Parametri da passare al metodo AMQP.
+        :return: Risposta ottenuta dal microservizio.
+        """
+        try:
+            payload = AMQPPayload(amqp_method, AMQPBody(**kwargs))
+            response = await self.__send_data(payload, self.amqp_provider, timeout)
+
+            if response.status == AMQPStatus.ERROR:
+                raise Exception(response.to_json())
+
+            return response
+
+        except Exception as e:
+            return AMQPResponse(amqp_method, AMQPStatus.ERROR, str(e))
+
+    async def connect_and_get_data(self, amqp_method: AMQPMethod, timeout: float = DEFAULT_TIMEOUT, **kwargs) -> AMQPResponse:
+        return await self.call(amqp_method, timeout=timeout, **kwargs)
+
+    async def __send_data(self, payload: AMQPPayload, amqp: AsyncAMQPProvider, timeout: float):
+        """
+        Invia dati crittografati a un microservizio e attende la risposta correlata.
+
+        :param payload: Payload AMQP da inviare al microservizio.
+        :param amqp: Provider AMQP asincrono utilizzato per comunicare con il microservizio.
+        :param timeout: Secondi massimi di attesa della risposta.
+        :return: Risposta ottenuta dal microservizio.
+        """
+        method = payload.method.value
+        data = payload.body.to_bytes() if payload.body else None
+
+        cipher = AMQPPayloadCipher.for_key(os.environ.get("BBSENDER_ENCRYPT_KEY"))
+        encrypted_data, _ = cipher.encrypt(data)
+        uuid = str(uuid4())
+        origin = os.environ.get("BBSENDER_ORIGIN")
+
+        reply = amqp.register(uuid)
+        try:
+            logger.debug("Sending data to %s with uuid %s", method, uuid)
+            await amqp.publish(origin, method, encrypted_data, corr_id=uuid)
+
+            try:
+                response = await asyncio.wait_for(reply, timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Timeout for %s with uuid %s", method, uuid)
+                raise Exception("Timeout")
+        finally:
+            amqp.discard(uuid)
+
+        return AMQPResponse.from_bytes(response)
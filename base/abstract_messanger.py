@@ -1,15 +1,46 @@
 from abc import ABC
-import sys
+import random
 import time
 import pika
 import os
+from pika.exceptions import AMQPConnectionError, ChannelClosed, ChannelWrongStateError
+
+from core.amqp.base.log import get_logger
+
+logger = get_logger(__name__)
 
 NUM_RETRIES = 5
+# Attesa prima del primo nuovo tentativo di connessione; raddoppia a ogni fallimento fino a RECONNECT_MAX_DELAY
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+
+# Errori che indicano la perdita della connessione o del canale: la connessione va ricreata.
+# NackError e UnroutableError (publisher confirms) non ne fanno parte: il messaggio è stato rifiutato
+# su una connessione sana e l'errore deve arrivare al chiamante
+CONNECTION_ERRORS = (AMQPConnectionError, ChannelClosed, ChannelWrongStateError)
+
+
+def method_queue(queue: str, method: str) -> str:
+    """
+    Coda dedicata a un metodo AMQP; la routing key è il nome della coda seguito da '_rk', come per le altre code.
+    """
+    return f"{queue}_{method}"
+
+
+def reconnect_delay(attempt: int) -> float:
+    """
+    Backoff esponenziale con jitter completo: i client disconnessi insieme non si riconnettono tutti nello stesso istante.
+    """
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
 
 class AbstractMessanger(ABC):
-    def __init__(self, queue: str, routing_key: str, callback: callable = None):
+    # Factory delle connessioni: sostituibile con un broker in memoria (vedi benchmark/fake_pika.py)
+    connection_factory = pika.BlockingConnection
+    
+    def __init__(self, queue: str, routing_key: str, callback: callable = None, confirm_delivery: bool = False, declare: bool = True, prefetch_count: int = None, auto_ack: bool = True, bindings: list = None, queue_arguments: dict = None):
         self.connection = None
         self.channel = None
+        self.consumer_tag = None
         
         self.username   = os.environ.get('RABBITMQ_USER')
         self.password   = os.environ.get('RABBITMQ_PASS')
@@ -20,6 +51,17 @@ class AbstractMessanger(ABC):
         self.queue = queue
         self.routing_key = routing_key
         self.callback = callback
+        # Publisher confirms: basic_publish attende l'ack del broker e solleva un errore se il messaggio è rifiutato
+        self.confirm_delivery = confirm_delivery
+        # Se False exchange, coda e binding sono già stati dichiarati da un'altra istanza e non vengono ripetuti
+        self.declare = declare
+        # Con auto_ack False il broker consegna al più prefetch_count messaggi non ancora confermati
+        self.prefetch_count = prefetch_count
+        self.auto_ack = auto_ack
+        # Ulteriori coppie (coda, routing key) dichiarate e collegate all'exchange insieme alla coda principale
+        self.bindings = bindings or []
+        # Argomenti della coda principale (ad esempio x-expires per le code temporanee degli stream)
+        self.queue_arguments = queue_arguments
         
         try:
             self.__validate_env_variables()
@@ -47,41 +89,72 @@ class AbstractMessanger(ABC):
             heartbeat=600,
             blocked_connection_timeout=300
         )
-        self.connection = pika.BlockingConnection(param)
+        # Letta dalla classe: una funzione assegnata a connection_factory non diventa un metodo legato all'istanza
+        self.connection = type(self).connection_factory(param)
         
     def __create_channel(self):
         self.channel = self.connection.channel()
-        self.channel.exchange_declare(exchange=self.exchange, exchange_type='direct')
+        if self.declare:
+            self.channel.exchange_declare(exchange=self.exchange, exchange_type='direct')
+        if self.confirm_delivery:
+            self.channel.confirm_delivery()
 
     # Setup queue
     def __create_queue(self):
-        self.channel.queue_declare(queue=self.queue, durable=False)
-        self.channel.queue_bind(exchange=self.exchange, queue=self.queue, routing_key=self.routing_key)
+        if self.declare:
+            self.channel.queue_declare(queue=self.queue, durable=False, arguments=self.queue_arguments)
+            self.channel.queue_bind(exchange=self.exchange, queue=self.queue, routing_key=self.routing_key)
+            for queue, routing_key in self.bindings:
+                self.channel.queue_declare(queue=queue, durable=False)
+                self.channel.queue_bind(exchange=self.exchange, queue=queue, routing_key=routing_key)
         if self.callback is not None:
-            self.channel.basic_consume(self.queue, self.callback, auto_ack=True)
+            if self.prefetch_count is not None:
+                self.channel.basic_qos(prefetch_count=self.prefetch_count)
+            self.consumer_tag = self.channel.basic_consume(self.queue, self.callback, auto_ack=self.auto_ack)
             
     def __start_connetion(self):
         try:
             self.__create_connection()
             self.__create_channel()
             self.__create_queue()
-            print('Connection and channel are open for queue: ', self.queue, file=sys.stderr)
+            logger.info("Connection and channel are open for queue: %s", self.queue)
         except Exception as e:
-            print(e, file=sys.stderr)
+            logger.error("Connection for queue %s failed: %s", self.queue, e)
             raise e
         
     def start_messanger(self):
-        retries = 0
-        try:
-            self.__start_connetion()
-        except Exception as e:
-            retries += 1
-            if retries > NUM_RETRIES:
-                raise Exception('Failed to connect to RabbitMQ, max retries reached')
-            
-            print('Retrying to connect to', self.hostname)
-            time.sleep(5)
-            return self.start_messanger()
+        for attempt in range(NUM_RETRIES + 1):
+            try:
+                return self.__start_connetion()
+            except Exception as e:
+                # Una connessione aperta a metà non deve restare appesa
+                self.__discard_connection()
+                if attempt == NUM_RETRIES:
+                    raise Exception('Failed to connect to RabbitMQ, max retries reached') from e
+                
+                delay = reconnect_delay(attempt)
+                logger.warning("Retrying to connect to %s in %.1f s (attempt %d of %d)", self.hostname, delay, attempt + 1, NUM_RETRIES)
+                time.sleep(delay)
+    
+    def reconnect(self):
+        """
+        Ricrea connessione e canale dopo un errore. Exchange, coda e binding vengono sempre ridichiarati,
+        perché un broker riavviato perde quelli non durable; il consumer riprende a ricevere sulla nuova connessione.
+        """
+        self.__discard_connection()
+        self.declare = True
+        self.start_messanger()
+    
+    def __discard_connection(self):
+        # Con la connessione già persa la chiusura può fallire: canale e connessione sono chiusi separatamente
+        for resource in (self.channel, self.connection):
+            try:
+                if resource is not None and resource.is_open:
+                    resource.close()
+            except Exception:
+                pass
+        self.channel = None
+        self.connection = None
     
     def close_connection(self):
         try:
@@ -0,0 +1,194 @@
+import asyncio
+import os
+from abc import ABC, abstractmethod
+
+from core.amqp.base.log import get_logger
+from core.amqp.base.provider import AMQPProviderType
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+logger = get_logger(__name__)
+
+
+class AsyncAMQPTransport(ABC):
+    """
+    Connessione asincrona al broker usata da AsyncAMQPProvider.
+
+    La callback di consume riceve (correlation_id, content_type, body) ed è eseguita nell'event loop.
+    """
+
+    @abstractmethod
+    async def connect(self):
+        pass
+
+    @abstractmethod
+    async def declare(self, queue: str, routing_key: str):
+        pass
+
+    @abstractmethod
+    async def consume(self, queue: str, callback: callable):
+        pass
+
+    @abstractmethod
+    async def publish(self, routing_key: str, body: bytes, content_type: str, corr_id: str):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+
+class AioPikaTransport(AsyncAMQPTransport):
+    """
+    Trasporto su aio-pika: una sola connessione e un solo canale per event loop.
+    """
+
+    def __init__(self):
+        if aio_pika is None:
+            raise Exception("aio-pika non installato")
+
+        required_variables = [
+            'RABBITMQ_USER',
+            'RABBITMQ_PASS',
+            'RABBITMQ_HOSTNAME',
+            'RABBITMQ_PORT',
+            'RABBITMQ_EXCHANGE'
+        ]
+        for var in required_variables:
+            if os.environ.get(var) is None:
+                raise Exception(f'Environment variable {var} is not defined')
+
+        self.username   = os.environ.get('RABBITMQ_USER')
+        self.password   = os.environ.get('RABBITMQ_PASS')
+        self.exchange_name = os.environ.get('RABBITMQ_EXCHANGE')
+        self.hostname   = os.environ.get('RABBITMQ_HOSTNAME')
+        self.port       = int(os.environ.get('RABBITMQ_PORT'))
+
+        self.connection = None
+        self.channel = None
+        self.exchange = None
+        self.queues = {}
+
+    async def connect(self):
+        if self.connection is not None:
+            return
+
+        self.connection = await aio_pika.connect_robust(
+            host=self.hostname,
+            port=self.port,
+            login=self.username,
+            password=self.password,
+            heartbeat=600
+        )
+        self.channel = await self.connection.channel()
+        self.exchange = await self.channel.declare_exchange(self.exchange_name, aio_pika.ExchangeType.DIRECT)
+
+    async def declare(self, queue: str, routing_key: str):
+        if queue in self.queues:
+            return
+
+        amqp_queue = await self.channel.declare_queue(queue, durable=False)
+        await amqp_queue.bind(self.exchange, routing_key=routing_key)
+        self.queues[queue] = amqp_queue
+
+    async def consume(self, queue: str, callback: callable):
+        async def on_message(message):
+            callback(message.correlation_id, message.content_type, message.body)
+
+        await self.queues[queue].consume(on_message, no_ack=True)
+
+    async def publish(self, routing_key: str, body: bytes, content_type: str, corr_id: str):
+        message = aio_pika.Message(body=body, content_type=content_type, correlation_id=corr_id)
+        await self.exchange.publish(message, routing_key=routing_key)
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+        self.connection = None
+        self.channel = None
+        self.exchange = None
+        self.queues = {}
+
+
+class AsyncAMQPProvider():
+    """
+    Versione asyncio di AMQPProvider, con la stessa interfaccia ma metodi coroutine.
+
+    Tutte le code condividono un'unica connessione sull'event loop e le risposte
+    sono correlate tramite asyncio.Future, quindi non serve un thread per chiamata.
+    """
+
+    instances = {}
+
+    def __init__(self, consumer_queue: str, producer_queue: str, has_producer: bool = True, transport: AsyncAMQPTransport = None):
+        # Questa coda descrive i dati richiesti al microservizio
+        self.consumer_queue = consumer_queue
+        self.consumer_queue_rk = consumer_queue + '_rk'
+
+        # Questa cosa descrive i dati restituiti dal microservizio
+        self.producer_queue = producer_queue
+        self.producer_queue_rk = producer_queue + '_rk'
+
+        # Risposte attese dai chiamanti, indicizzate per correlation_id
+        self.pending_replies = {}
+
+        self.has_producer = has_producer
+        self.transport = transport if transport is not None else AioPikaTransport()
+
+    @staticmethod
+    def get_instance(amqp_provider_type: AMQPProviderType):
+        return AsyncAMQPProvider.instances.get(amqp_provider_type)
+
+    @staticmethod
+    def create_istance(consumer_queue: str, producer_queue: str, amqp_provider_type: AMQPProviderType, transport: AsyncAMQPTransport = None):
+        if AsyncAMQPProvider.get_instance(amqp_provider_type) is None:
+            istance = AsyncAMQPProvider(consumer_queue, producer_queue, transport=transport)
+            AsyncAMQPProvider.instances[amqp_provider_type] = istance
+
+        return AsyncAMQPProvider.get_instance(amqp_provider_type)
+
+    def register(self, corr_id: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.pending_replies[corr_id] = future
+        return future
+
+    def discard(self, corr_id: str):
+        future = self.pending_replies.pop(corr_id, None)
+        if future is not None and not future.done():
+            future.cancel()
+
+    def data_received_response(self, corr_id: str, content_type: str, body: bytes):
+        future = self.pending_replies.pop(corr_id, None)
+        if future is None or future.done():
+            logger.debug("No caller waiting for response with uuid %s", corr_id)
+            return
+
+        future.set_result(body)
+
+    async def provide_listening(self):
+        await self.transport.connect()
+        await self.transport.declare(self.consumer_queue, self.consumer_queue_rk)
+        await self.transport.consume(self.consumer_queue, self.data_received_response)
+
+    async def provide_publishing(self):
+        await self.transport.connect()
+        if self.has_producer:
+            await self.transport.declare(self.producer_queue, self.producer_queue_rk)
+
+    async def publish(self, origin: str, method: str, body: bytes, corr_id: str):
+        if not self.has_producer:
+            await self.transport.declare(self.producer_queue + "_" + origin, self.producer_queue_rk)
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        content_type = os.environ["BBSENDER_ORIGIN"] + "|" + method
+        await self.transport.publish(self.producer_queue_rk, body, content_type, corr_id)
+
+    async def close(self):
+        for corr_id in list(self.pending_replies):
+            self.discard(corr_id)
+        await self.transport.close()
@@ -0,0 +1,106 @@
+import threading
+import zlib
+
+from cryptography.fernet import Fernet
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Header con le compressioni accettate dal mittente per la risposta, separate da virgola
+HEADER_ACCEPT_ENCODING = "x-accept-encoding"
+
+# Sotto questa dimensione (in byte) il payload non viene compresso
+COMPRESSION_MIN_SIZE = 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+ENCODING_ZLIB = "zlib"
+ENCODING_ZSTD = "zstd"
+
+# Compressioni disponibili in questo processo, in ordine di preferenza
+SUPPORTED_ENCODINGS = ([ENCODING_ZSTD] if zstandard is not None else []) + [ENCODING_ZLIB]
+
+
+def negotiate_encoding(accept_encoding: str):
+    """
+    Restituisce la prima compressione supportata tra quelle accettate dal mittente, None se nessuna.
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = [encoding.strip() for encoding in accept_encoding.split(",")]
+    for encoding in accepted:
+        if encoding in SUPPORTED_ENCODINGS:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str):
+    """
+    Comprime il payload se supera COMPRESSION_MIN_SIZE.
+
+    :return: Coppia (dati, content_encoding); content_encoding è None se i dati non sono stati compressi.
+    """
+    if encoding is None or len(data) < COMPRESSION_MIN_SIZE:
+        return data, None
+
+    if encoding == ENCODING_ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL), ENCODING_ZLIB
+    if encoding == ENCODING_ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), ENCODING_ZSTD
+
+    raise Exception(f"Compressione {encoding} non supportata")
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    if not encoding:
+        return data
+
+    if encoding == ENCODING_ZLIB:
+        return zlib.decompress(data)
+    if encoding == ENCODING_ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    raise Exception(f"Compressione {encoding} non supportata")
+
+
+class AMQPPayloadCipher:
+    """
+    Cifratura Fernet dei payload, con compressione opzionale applicata prima della cifratura.
+
+    Le istanze sono create una sola volta per chiave tramite for_key e riutilizzate.
+    """
+
+    __instances = {}
+    __instances_lock = threading.Lock()
+
+    def __init__(self, key: str):
+        self.fernet = Fernet(key)
+
+    @staticmethod
+    def for_key(key: str):
+        if key is None:
+            raise Exception("Chiave di cifratura non impostata")
+
+        cipher = AMQPPayloadCipher.__instances.get(key)
+        if cipher is None:
+            with AMQPPayloadCipher.__instances_lock:
+                cipher = AMQPPayloadCipher.__instances.setdefault(key, AMQPPayloadCipher(key))
+        return cipher
+
+    def encrypt(self, data, encoding: str = None):
+        """
+        :param data: Payload in chiaro, str o bytes.
+        :param encoding: Compressione da applicare prima della cifratura, None per nessuna.
+        :return: Coppia (token, content_encoding).
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        data, content_encoding = compress(data, encoding)
+        return self.fernet.encrypt(data), content_encoding
+
+    def decrypt(self, token: bytes, content_encoding: str = None) -> bytes:
+        return decompress(self.fernet.decrypt(token), content_encoding)
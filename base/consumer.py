@@ -2,21 +2,213 @@
 # # Pika - Python Message Queue Asynchronous Library AMQP
 
 import os
+from collections import deque
+from concurrent.futures import Future
+from threading import Event, Lock
 from pika.exceptions import AMQPConnectionError
 import pika
-import time
 import collections
 
-from core.amqp.base.abstract_messanger import AbstractMessanger
+from core.amqp.base.abstract_messanger import CONNECTION_ERRORS, AbstractMessanger
+from core.amqp.base.log import get_logger
 
 collections.Callable = collections.abc.Callable
 
+logger = get_logger(__name__)
+
+# Secondi massimi di attesa di eventi della connessione prima di ricontrollare la richiesta di stop
+LISTEN_TIME_LIMIT = 1
+
 class AMQPConsumer(AbstractMessanger):
     
-    def __init__(self, queue: str, routing_key: str, callback: callable):
-        super().__init__(queue, routing_key, callback)
+    def __init__(self, queue: str, routing_key: str, callback: callable, prefetch_count: int = None, manual_ack: bool = False, on_connection_lost: callable = None, queue_arguments: dict = None):
+        """
+        :param prefetch_count: Numero massimo di messaggi consegnati e non ancora confermati.
+        :param manual_ack: Se True i messaggi vanno confermati con ack/nack al termine della gestione.
+        :param on_connection_lost: Funzione chiamata con l'eccezione quando la connessione cade, prima di riconnettersi.
+        """
+        self.manual_ack = manual_ack
+        self.on_connection_lost = on_connection_lost
+        self.__handler = callback
+        
+        # Delivery tag consegnati e non ancora confermati, in ordine di consegna (solo thread della connessione)
+        self.__outstanding = deque()
+        self.__settled = {}
+        
+        # Conferme richieste dagli altri thread, in attesa di essere inviate dal thread della connessione
+        self.__lock = Lock()
+        self.__completed = []
+        
+        self.__stop_event = Event()
+        
+        super().__init__(
+            queue,
+            routing_key,
+            self.__on_message if manual_ack else callback,
+            prefetch_count=prefetch_count,
+            auto_ack=not manual_ack,
+            queue_arguments=queue_arguments
+        )
         
     def listen(self):
-        while True:
-            self.connection.process_data_events()
-            time.sleep(0.1)
\ No newline at end of file
+        """
+        Serve gli eventi della connessione finché non viene chiamato stop.
+        
+        process_data_events ritorna appena una consegna è stata gestita, quindi i messaggi
+        arrivano alla callback senza attese; lo stesso ciclo gestisce gli heartbeat.
+        Se la connessione cade, il consumer si riconnette e riprende a ricevere.
+        """
+        self.__stop_event.clear()
+        while not self.__stop_event.is_set():
+            try:
+                self.connection.process_data_events(time_limit=LISTEN_TIME_LIMIT)
+            except CONNECTION_ERRORS as e:
+                if self.__stop_event.is_set():
+                    break
+                logger.warning("Connection lost for queue %s: %s", self.queue, e)
+                self.__recover(e)
+        
+        # Le conferme richieste prima dello stop sono inviate prima di lasciare la connessione:
+        # altrimenti i messaggi già gestiti verrebbero riconsegnati ed eseguiti di nuovo
+        if self.manual_ack and self.channel is not None and self.channel.is_open:
+            try:
+                self.__flush()
+            except CONNECTION_ERRORS as e:
+                logger.warning("Pending acks for queue %s lost: %s", self.queue, e)
+    
+    def __recover(self, error: Exception):
+        # I delivery tag del canale perso non valgono più: il broker riconsegna i messaggi non confermati
+        self.__outstanding.clear()
+        self.__settled.clear()
+        with self.__lock:
+            self.__completed = []
+        
+        if self.on_connection_lost is not None:
+            self.on_connection_lost(error)
+        
+        while not self.__stop_event.is_set():
+            try:
+                self.reconnect()
+                logger.info("Consumption resumed for queue %s", self.queue)
+                return
+            except Exception as e:
+                logger.error("Reconnection for queue %s failed: %s", self.queue, e)
+    
+    def stop(self):
+        """
+        Chiede a listen di terminare. Può essere chiamato da qualsiasi thread.
+        """
+        self.__stop_event.set()
+        connection = self.connection
+        if connection is not None and connection.is_open:
+            # Risveglia subito process_data_events invece di attendere LISTEN_TIME_LIMIT
+            try:
+                connection.add_callback_threadsafe(lambda: None)
+            except CONNECTION_ERRORS:
+                pass
+    
+    def queue_depth(self, timeout: float = LISTEN_TIME_LIMIT * 5) -> int:
+        """
+        Messaggi in attesa nella coda del broker, letti con una dichiarazione passiva dal thread della connessione.
+        Da chiamare da un thread diverso da quello che esegue listen.
+        """
+        depth = Future()
+        
+        def declare():
+            try:
+                depth.set_result(self.channel.queue_declare(queue=self.queue, passive=True).method.message_count)
+            except Exception as e:
+                depth.set_exception(e)
+        
+        self.connection.add_callback_threadsafe(declare)
+        return depth.result(timeout=timeout)
+    
+    def cancel(self, timeout: float = LISTEN_TIME_LIMIT * 5) -> bool:
+        """
+        Smette di ricevere nuove consegne lasciando aperta la connessione, così le conferme
+        dei messaggi in lavorazione possono ancora essere inviate. Può essere chiamato da qualsiasi thread
+        diverso da quello che esegue listen: attende che la cancellazione sia eseguita dal thread della connessione,
+        dopo di che la callback non riceve più messaggi.
+        
+        :return: False se la cancellazione non è stata eseguita entro timeout.
+        """
+        connection = self.connection
+        if connection is None or not connection.is_open:
+            return True
+        
+        cancelled = Future()
+        
+        def cancel():
+            try:
+                self.__cancel()
+                cancelled.set_result(True)
+            except Exception as e:
+                cancelled.set_exception(e)
+        
+        try:
+            connection.add_callback_threadsafe(cancel)
+            return cancelled.result(timeout=timeout)
+        except Exception as e:
+            logger.warning("Cancel of consumer on queue %s failed: %s", self.queue, e)
+            return False
+    
+    def __cancel(self):
+        # Con la conferma manuale pika rifiuta i messaggi già ricevuti e non ancora consegnati alla callback
+        if self.channel is not None and self.consumer_tag is not None:
+            self.channel.basic_cancel(self.consumer_tag)
+            self.consumer_tag = None
+    
+    def ack(self, delivery_tag: int, channel=None):
+        """
+        Conferma un messaggio. Può essere chiamato da qualsiasi thread.
+        
+        :param channel: Canale che ha consegnato il messaggio; se nel frattempo il consumer si è riconnesso la conferma viene ignorata.
+        """
+        self.__settle(delivery_tag, True, False, channel)
+    
+    def nack(self, delivery_tag: int, requeue: bool = False, channel=None):
+        """
+        Rifiuta un messaggio. Può essere chiamato da qualsiasi thread.
+        """
+        self.__settle(delivery_tag, False, requeue, channel)
+    
+    def __on_message(self, ch, method, props, body):
+        self.__outstanding.append(method.delivery_tag)
+        self.__handler(ch, method, props, body)
+    
+    def __settle(self, delivery_tag: int, ack: bool, requeue: bool, channel):
+        with self.__lock:
+            self.__completed.append((channel, delivery_tag, ack, requeue))
+            schedule = len(self.__completed) == 1
+        
+        # Una sola callback per gruppo di conferme: quelle arrivate nel frattempo sono inviate insieme
+        connection = self.connection
+        if schedule and connection is not None:
+            try:
+                connection.add_callback_threadsafe(self.__flush)
+            except CONNECTION_ERRORS:
+                # Le conferme in sospeso sono scartate alla riconnessione
+                pass
+    
+    def __flush(self):
+        with self.__lock:
+            completed, self.__completed = self.__completed, []
+        
+        for channel, delivery_tag, ack, requeue in completed:
+            if channel is not None and channel is not self.channel:
+                continue
+            if not ack:
+                self.channel.basic_nack(delivery_tag=delivery_tag, multiple=False, requeue=requeue)
+            self.__settled[delivery_tag] = ack
+        
+        # Un unico ack multiple copre il prefisso contiguo di messaggi già gestiti
+        last_ack = None
+        count = 0
+        while self.__outstanding and self.__outstanding[0] in self.__settled:
+            delivery_tag = self.__outstanding.popleft()
+            if self.__settled.pop(delivery_tag):
+                last_ack = delivery_tag
+                count += 1
+        
+        if last_ack is not None:
+            self.channel.basic_ack(delivery_tag=last_ack, multiple=count > 1)
@@ -0,0 +1,167 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Header con l'identificativo di traccia (il corr_id della richiesta), propagato anche nella risposta
+HEADER_TRACE_ID = "x-trace-id"
+# Header con l'istante di invio (epoch in secondi), usato per misurare l'attesa in coda
+HEADER_SENT_AT = "x-sent-at"
+
+# Durata delle fasi della chiamata, con etichette stage e method
+STAGE_SECONDS = "amqp_stage_seconds"
+# Chiamate in corso, con etichette side (client/server) e method
+IN_FLIGHT = "amqp_in_flight"
+# Errori, con etichette side, stage e method
+ERRORS_TOTAL = "amqp_errors_total"
+# Richieste scartate perché scadute prima dell'esecuzione, con etichette side e method
+EXPIRED_TOTAL = "amqp_expired_total"
+# Messaggi in attesa nella coda del broker, con etichetta queue
+QUEUE_DEPTH = "amqp_queue_depth"
+
+# Limiti superiori (in secondi) dei bucket degli istogrammi
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class AMQPInstrumentation:
+    """
+    Interfaccia di strumentazione del ciclo di vita delle chiamate RPC.
+
+    L'implementazione di default non registra nulla; set_instrumentation installa
+    un'implementazione concreta (ad esempio InMemoryInstrumentation) per tutto il processo.
+    """
+
+    def observe(self, name: str, value: float, **labels):
+        pass
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        pass
+
+    def add(self, name: str, delta: float, **labels):
+        pass
+
+    def set(self, name: str, value: float, **labels):
+        pass
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def in_flight(self, name: str, **labels):
+        self.add(name, 1, **labels)
+        try:
+            yield
+        finally:
+            self.add(name, -1, **labels)
+
+
+class InMemoryInstrumentation(AMQPInstrumentation):
+    """
+    Istogrammi, contatori e gauge mantenuti in memoria, esportabili nel formato testuale di Prometheus.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+
+        self.__lock = threading.Lock()
+        # (nome, etichette) -> [conteggi per bucket..., +Inf], somma
+        self.__histograms = {}
+        self.__counters = {}
+        self.__gauges = {}
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect_left(self.buckets, value)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += value
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def add(self, name: str, delta: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__gauges[key] = self.__gauges.get(key, 0) + delta
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__gauges[key] = value
+
+    def percentile(self, name: str, fraction: float, **labels) -> float:
+        """
+        Stima del percentile come limite superiore del bucket che lo contiene.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            counts = list(histogram[0]) if histogram is not None else []
+
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= fraction * total:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def render_prometheus(self) -> str:
+        with self.__lock:
+            histograms = {key: (list(counts), total) for key, (counts, total) in self.__histograms.items()}
+            counters = dict(self.__counters)
+            gauges = dict(self.__gauges)
+
+        lines = []
+        for metric_type, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE {name} {metric_type}")
+                for (metric_name, labels), value in sorted(values.items()):
+                    if metric_name == name:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric_name, labels), (counts, total) in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+_instrumentation = AMQPInstrumentation()
+
+
+def get_instrumentation() -> AMQPInstrumentation:
+    return _instrumentation
+
+
+def set_instrumentation(instrumentation: AMQPInstrumentation):
+    global _instrumentation
+    _instrumentation = instrumentation
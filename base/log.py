@@ -0,0 +1,94 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+# Logger radice del pacchetto: tutti i moduli usano logger figli ottenuti con get_logger(__name__)
+LOGGER_NAME = "core.amqp"
+# Livello di default, sovrascrivibile con la variabile d'ambiente AMQP_LOG_LEVEL
+DEFAULT_LOG_LEVEL = "INFO"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s"
+# Caratteri massimi dei payload riportati nei log
+LOG_PAYLOAD_MAX_LENGTH = 256
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+# Senza configurazione i record arrivano agli handler dell'applicazione; il NullHandler evita solo
+# l'handler di ultima istanza di logging quando l'applicazione non ne configura nessuno
+logging.getLogger(LOGGER_NAME).addHandler(logging.NullHandler())
+
+
+def setup_logging(level: str = None, stream=None):
+    """
+    Configura il logger del pacchetto con un handler a coda: i thread delle richieste accodano
+    i record e un thread dedicato li scrive su stream (stderr di default). Idempotente.
+
+    È facoltativa e va chiamata all'avvio dei processi server: i record del pacchetto
+    non vengono più propagati agli handler dell'applicazione.
+    """
+    global _listener
+
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        root = logging.getLogger(LOGGER_NAME)
+        root.setLevel((level or os.environ.get("AMQP_LOG_LEVEL", DEFAULT_LOG_LEVEL)).upper())
+
+        handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+        records = queue.SimpleQueue()
+        root.addHandler(logging.handlers.QueueHandler(records))
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def _reset_after_fork():
+    # Il thread del listener non sopravvive alla fork: il processo figlio configura un proprio handler a coda
+    global _listener
+
+    if _listener is None:
+        return
+
+    root = logging.getLogger(LOGGER_NAME)
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    _listener = None
+    setup_logging()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+class truncate:
+    """
+    Riferimento pigro a un payload da loggare: viene convertito in stringa e troncato
+    solo se il record viene effettivamente emesso.
+    """
+
+    __slots__ = ("payload", "max_length")
+
+    def __init__(self, payload, max_length: int = LOG_PAYLOAD_MAX_LENGTH):
+        self.payload = payload
+        self.max_length = max_length
+
+    def __str__(self):
+        text = self.payload.decode("utf-8", "replace") if isinstance(self.payload, (bytes, bytearray)) else str(self.payload)
+        if len(text) <= self.max_length:
+            return text
+        return f"{text[:self.max_length]}... ({len(text)} caratteri)"
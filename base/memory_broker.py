@@ -0,0 +1,65 @@
+import asyncio
+from collections import defaultdict
+
+from core.amqp.base.async_provider import AsyncAMQPTransport
+
+
+class AsyncMemoryBroker:
+    """
+    Broker in memoria con exchange di tipo direct, da usare al posto di RabbitMQ nei test.
+
+    Le code consegnano i messaggi ai consumer registrati in round robin,
+    sempre tramite l'event loop, come farebbe una connessione reale.
+    """
+
+    def __init__(self):
+        self.bindings = defaultdict(set)
+        self.queues = {}
+        self.consumers = defaultdict(list)
+        self.published = 0
+
+    def declare(self, queue: str, routing_key: str):
+        self.queues.setdefault(queue, asyncio.Queue())
+        self.bindings[routing_key].add(queue)
+
+    def consume(self, queue: str, callback: callable):
+        self.consumers[queue].append(callback)
+        if len(self.consumers[queue]) == 1:
+            asyncio.get_running_loop().create_task(self.__deliver(queue))
+
+    def publish(self, routing_key: str, body: bytes, content_type: str, corr_id: str):
+        self.published += 1
+        for queue in self.bindings.get(routing_key, ()):
+            self.queues[queue].put_nowait((corr_id, content_type, body))
+
+    async def __deliver(self, queue: str):
+        index = 0
+        while True:
+            corr_id, content_type, body = await self.queues[queue].get()
+            consumers = self.consumers[queue]
+            consumers[index % len(consumers)](corr_id, content_type, body)
+            index += 1
+
+
+class AsyncMemoryTransport(AsyncAMQPTransport):
+    """
+    Trasporto di AsyncAMQPProvider collegato a un AsyncMemoryBroker.
+    """
+
+    def __init__(self, broker: AsyncMemoryBroker):
+        self.broker = broker
+
+    async def connect(self):
+        pass
+
+    async def declare(self, queue: str, routing_key: str):
+        self.broker.declare(queue, routing_key)
+
+    async def consume(self, queue: str, callback: callable):
+        self.broker.consume(queue, callback)
+
+    async def publish(self, routing_key: str, body: bytes, content_type: str, corr_id: str):
+        self.broker.publish(routing_key, body, content_type, corr_id)
+
+    async def close(self):
+        pass
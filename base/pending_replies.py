@@ -0,0 +1,201 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeoutError
+
+# Secondi dopo i quali una richiesta in attesa viene scartata; deve superare il timeout massimo dei chiamanti
+PENDING_TTL = 120
+# Numero massimo di richieste in attesa: oltre questo limite vengono scartate le più vecchie
+PENDING_MAX_SIZE = 100000
+# Numero di corr_id scaduti ricordati per riconoscere le risposte tardive
+EXPIRED_MEMORY = 10000
+
+
+class AMQPPendingReplies:
+    """
+    Registro delle risposte attese, indicizzate per correlation_id.
+
+    Ogni richiesta registra un Future prima della publish; la callback del consumer
+    lo completa appena arriva la risposta, risvegliando subito il chiamante.
+
+    Il registro è limitato: le richieste più vecchie di ttl secondi o oltre max_size vengono
+    completate con un errore, e le risposte che arrivano dopo la scadenza sono scartate e contate.
+    """
+
+    def __init__(self, ttl: float = PENDING_TTL, max_size: int = PENDING_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self.__lock = threading.Lock()
+        # corr_id -> (Future, istante di registrazione), in ordine di registrazione
+        self.__pending = OrderedDict()
+        self.__expired = OrderedDict()
+
+        self.expired = 0
+        self.evicted = 0
+        self.late_replies = 0
+        self.unknown_replies = 0
+
+    def register(self, corr_id: str) -> Future:
+        future = Future()
+        self.__add(corr_id, future)
+        return future
+
+    def resolve(self, corr_id: str, response) -> bool:
+        """
+        Completa il Future associato al corr_id.
+
+        :return: False se nessuno è in attesa della risposta (risposta tardiva o sconosciuta).
+        """
+        pending = self.__pop(corr_id, reply=True)
+        if pending is None:
+            return False
+
+        try:
+            pending.set_result(response)
+        except InvalidStateError:
+            return False
+        return True
+
+    def touch(self, corr_id: str) -> bool:
+        """
+        Rinnova la scadenza di una richiesta ancora attiva, ad esempio a ogni chunk di uno stream
+        che dura più di ttl secondi.
+
+        :return: False se la richiesta non è più in attesa.
+        """
+        with self.__lock:
+            if corr_id not in self.__pending:
+                return False
+            pending, _ = self.__pending.pop(corr_id)
+            # Il registro resta in ordine di scadenza, come richiesto da __pop_expired
+            self.__pending[corr_id] = (pending, time.monotonic())
+        return True
+
+    def fail(self, corr_id: str, exception: Exception) -> bool:
+        """
+        Completa con un errore il Future associato al corr_id, ad esempio se la publish è fallita.
+        """
+        pending = self.__pop(corr_id)
+        if pending is None:
+            return False
+
+        self.__fail(pending, exception)
+        return True
+
+    def fail_all(self, exception: Exception) -> int:
+        """
+        Completa con un errore tutte le richieste in attesa, ad esempio quando la connessione del consumer cade.
+
+        :return: Numero di richieste completate.
+        """
+        with self.__lock:
+            pending = [pending for pending, _ in self.__pending.values()]
+            for corr_id in self.__pending:
+                self.__remember_expired(corr_id)
+            self.__pending.clear()
+
+        for item in pending:
+            self.__fail(item, exception)
+        return len(pending)
+
+    def discard(self, corr_id: str):
+        """
+        Rimuove la richiesta; se era ancora in attesa il corr_id è considerato scaduto.
+        """
+        with self.__lock:
+            pending, _ = self.__pending.pop(corr_id, (None, None))
+            if pending is not None:
+                self.__remember_expired(corr_id)
+
+        if pending is not None:
+            pending.cancel()
+
+    def stats(self) -> dict:
+        """
+        Richieste in attesa, distribuzione della loro età in secondi e contatori di scadenze e risposte scartate.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            ages = sorted(now - registered_at for _, registered_at in self.__pending.values())
+            counters = {
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "late_replies": self.late_replies,
+                "unknown_replies": self.unknown_replies
+            }
+
+        def percentile(fraction: float) -> float:
+            if not ages:
+                return 0.0
+            return ages[min(len(ages) - 1, int(fraction * len(ages)))]
+
+        return {
+            "in_flight": len(ages),
+            "age_p50": percentile(0.5),
+            "age_p90": percentile(0.9),
+            "age_p99": percentile(0.99),
+            "age_max": ages[-1] if ages else 0.0,
+            **counters
+        }
+
+    def __add(self, corr_id: str, pending):
+        now = time.monotonic()
+        with self.__lock:
+            dropped = self.__pop_expired(now)
+            while len(self.__pending) >= self.max_size:
+                old_corr_id, (old_pending, _) = self.__pending.popitem(last=False)
+                self.__remember_expired(old_corr_id)
+                self.evicted += 1
+                dropped.append(old_pending)
+            self.__pending[corr_id] = (pending, now)
+
+        for old_pending in dropped:
+            self.__fail(old_pending, FutureTimeoutError("Richiesta scartata dal registro delle risposte"))
+
+    def __pop(self, corr_id: str, reply: bool = False):
+        with self.__lock:
+            pending, _ = self.__pending.pop(corr_id, (None, None))
+            if pending is None and reply:
+                self.__count_unexpected(corr_id)
+        return pending
+
+    def __pop_expired(self, now: float) -> list:
+        # Da chiamare con il lock acquisito: le richieste sono in ordine di registrazione, quindi basta guardare le prime
+        dropped = []
+        while self.__pending:
+            corr_id, (pending, registered_at) = next(iter(self.__pending.items()))
+            if now - registered_at < self.ttl:
+                break
+            del self.__pending[corr_id]
+            self.__remember_expired(corr_id)
+            self.expired += 1
+            dropped.append(pending)
+        return dropped
+
+    def __remember_expired(self, corr_id: str):
+        # Da chiamare con il lock acquisito
+        self.__expired[corr_id] = None
+        if len(self.__expired) > EXPIRED_MEMORY:
+            self.__expired.popitem(last=False)
+
+    def __count_unexpected(self, corr_id: str):
+        # Da chiamare con il lock acquisito
+        if self.__expired.pop(corr_id, False) is None:
+            self.late_replies += 1
+        else:
+            self.unknown_replies += 1
+
+    def __fail(self, pending: Future, exception: Exception):
+        try:
+            pending.set_exception(exception)
+        except InvalidStateError:
+            pass
+
+    def __contains__(self, corr_id: str):
+        with self.__lock:
+            return corr_id in self.__pending
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__pending)
@@ -2,58 +2,269 @@
 # # Pika - Python Message Queue Asynchronous Library AMQP
 
 import os
-import sys
+import queue as queue_module
+import threading
 import time
 import pika
 import collections
+from concurrent.futures import Future
 
-from core.amqp.base.abstract_messanger import AbstractMessanger
+from core.amqp.base.abstract_messanger import CONNECTION_ERRORS, AbstractMessanger, method_queue, reconnect_delay
+from core.amqp.base.log import get_logger
 
 collections.Callable = collections.abc.Callable
 
+logger = get_logger(__name__)
+
+# Numero massimo di messaggi in coda al thread di pubblicazione prima di bloccare i chiamanti
+PIPELINE_MAX_PENDING = 10000
+# Secondi di inattività dopo i quali il thread di pubblicazione serve gli eventi della connessione (heartbeat)
+PIPELINE_IDLE_TIME = 1
+
+
+class AMQPThreadCounters:
+    """
+    Contatori di publish per thread.
+
+    Ogni thread incrementa solo il proprio contatore, senza lock: il lock serve
+    soltanto a registrare il contatore alla prima publish del thread.
+    Il thread di pubblicazione del producer pipelined incrementa invece il contatore
+    del chiamante indicandone il nome, sotto lock.
+    """
+
+    def __init__(self):
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__counters = {}
+
+    def increment(self, thread_name: str = None):
+        """
+        :param thread_name: Thread a cui attribuire la publish, di default quello corrente.
+        """
+        if thread_name is not None:
+            with self.__lock:
+                counter = self.__counters.setdefault(thread_name, [0, time.monotonic(), 0.0])
+                counter[0] += 1
+                counter[2] = time.monotonic()
+            return
+
+        counter = getattr(self.__local, "counter", None)
+        if counter is None:
+            # [publish, istante della prima publish, istante dell'ultima publish]
+            counter = [0, time.monotonic(), 0.0]
+            self.__local.counter = counter
+            with self.__lock:
+                self.__counters[threading.current_thread().name] = counter
+
+        counter[0] += 1
+        counter[2] = time.monotonic()
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            counters = list(self.__counters.items())
+
+        stats = {}
+        for name, (published, first, last) in counters:
+            elapsed = last - first
+            stats[name] = {
+                "published": published,
+                "rate": published / elapsed if elapsed > 0 else 0.0
+            }
+        return stats
+
+
 class AMQPProducer(AbstractMessanger):
 
-    def __init__(self, queue: str, routing_key: str):
-        super().__init__(queue, routing_key)
+    def __init__(self, queue: str, routing_key: str, confirm_delivery: bool = False, declare: bool = True, methods: tuple = (), queue_arguments: dict = None):
+        """
+        :param methods: Metodi instradati sulla propria coda (vedi method_queue); gli altri usano routing_key.
+        """
+        self.method_routing_keys = {method: method_queue(queue, method) + "_rk" for method in methods}
+        bindings = [(method_queue(queue, method), routing_key) for method, routing_key in self.method_routing_keys.items()]
+        super().__init__(queue, routing_key, confirm_delivery=confirm_delivery, declare=declare, bindings=bindings, queue_arguments=queue_arguments)
+        # Il canale pika non è thread-safe: le publish concorrenti sulla stessa istanza sono serializzate
+        self.__publish_lock = threading.Lock()
+        self.counters = AMQPThreadCounters()
         
 
-    def publish(self, method, corr_id, body):
+    def publish(self, method, corr_id, body, properties: dict = None, routing_key: str = None):
+        """
+        :param properties: Proprietà AMQP aggiuntive del messaggio (ad esempio headers o content_encoding).
+        :param routing_key: Routing key del messaggio, di default quella della coda o del metodo:
+            permette di pubblicare su un'altra coda (ad esempio quella di uno stream) senza una nuova connessione.
+        """
+        self._send(method, corr_id, body, properties, routing_key)
+        self.counters.increment()
+
+    def _send(self, method, corr_id, body, properties: dict = None, routing_key: str = None):
+        # Publish senza conteggio: i contatori sono aggiornati dal chiamante solo a invio riuscito
         try:
-            if not self.connection:
-                raise Exception('Connection not open')
+            origin = os.environ.get("BBSENDER_ORIGIN")
+            if origin is None:
+                raise Exception("BBSENDER_ORIGIN environment variable not set")
             
-            if self.connection and self.channel:
-                origin = os.environ["BBSENDER_ORIGIN"]
-                if origin is None:
-                    raise Exception("BBSENDER_ORIGIN environment variable not set")
-                
             content_type = origin + "|" + method
             
             props = pika.BasicProperties(
                 content_type=content_type,
                 correlation_id=corr_id,
+                **(properties or {})
             )
             
-            self.channel.basic_publish(
-                exchange=self.exchange,
-                routing_key=self.routing_key,
-                body=body,
-                properties=props
-            )
-            
-            print("Message sent", file=sys.stderr)
+            with self.__publish_lock:
+                if self.connection is None:
+                    # L'ultima riconnessione è fallita: si riprova prima di pubblicare invece di fallire per sempre
+                    self.reconnect()
+                
+                if routing_key is None:
+                    routing_key = self.method_routing_keys.get(method, self.routing_key)
+                try:
+                    self.__basic_publish(routing_key, body, props)
+                except CONNECTION_ERRORS as e:
+                    # Connessione persa: il messaggio non è stato inviato, viene ripubblicato una volta sulla nuova connessione
+                    logger.warning("Connection lost for queue %s, reconnecting: %s", self.queue, e)
+                    self.reconnect()
+                    self.__basic_publish(routing_key, body, props)
             
-            time.sleep(1)
+            logger.debug("Message sent to %s with uuid %s", method, corr_id)
         except Exception as e:
             raise e
-    
 
+    def __basic_publish(self, routing_key: str, body, props):
+        # Con i publisher confirms, mandatory fa segnalare anche i messaggi non instradabili
+        self.channel.basic_publish(
+            exchange=self.exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=props,
+            mandatory=self.confirm_delivery
+        )
 
 
+class AMQPPipelinedProducer(AMQPProducer):
+    """
+    Producer che delega le publish a un thread dedicato, unico proprietario della connessione.
+    Più thread possono pubblicare in parallelo senza condividere il canale pika.
 
+    publish accoda il messaggio e restituisce subito un Future, completato con il corr_id
+    quando il messaggio è stato consegnato al broker (o confermato, con confirm_delivery).
+    """
 
+    def __init__(self, queue: str, routing_key: str, confirm_delivery: bool = False, max_pending: int = PIPELINE_MAX_PENDING, methods: tuple = ()):
+        super().__init__(queue, routing_key, confirm_delivery=confirm_delivery, methods=methods)
+        self.__messages = queue_module.Queue(maxsize=max_pending)
+        self.__thread = None
+        self.__ready = threading.Event()
+        self.__closing = threading.Event()
+        self.__start_error = None
 
+    def start_messanger(self):
+        if threading.current_thread() is self.__thread:
+            return super().start_messanger()
 
+        if self.__thread is not None and self.__thread.is_alive():
+            return
 
+        self.__ready.clear()
+        self.__closing.clear()
+        self.__start_error = None
+        self.__thread = threading.Thread(target=self.__run, name=f"amqp-publisher-{self.queue}", daemon=True)
+        self.__thread.start()
+        self.__ready.wait()
 
+        if self.__start_error is not None:
+            raise self.__start_error
+
+    def publish(self, method, corr_id, body, properties: dict = None, routing_key: str = None) -> Future:
+        if self.__thread is None or not self.__thread.is_alive():
+            raise Exception('Publisher thread not running')
+
+        future = Future()
+        self.__messages.put((method, corr_id, body, properties, future, threading.current_thread().name, routing_key))
+        return future
+
+    def close_connection(self):
+        if threading.current_thread() is self.__thread:
+            return super().close_connection()
+
+        if self.__thread is not None and self.__thread.is_alive():
+            # Il sentinella viene accodato dopo i messaggi pendenti, che vengono comunque pubblicati
+            self.__closing.set()
+            self.__messages.put(None)
+            self.__thread.join()
+        self.__thread = None
+
+    def __run(self):
+        try:
+            self.start_messanger()
+        except Exception as e:
+            self.__start_error = e
+        finally:
+            self.__ready.set()
+
+        if self.__start_error is not None:
+            return
+
+        # Il thread termina solo alla chiusura: se il broker resta irraggiungibile oltre i tentativi
+        # di start_messanger, i messaggi in coda falliscono e la riconnessione riprende con backoff
+        failures = 0
+        while True:
+            try:
+                if self.connection is None:
+                    try:
+                        self.reconnect()
+                        failures = 0
+                        logger.info("Publisher for queue %s reconnected", self.queue)
+                    except Exception as e:
+                        logger.error("Publisher for queue %s cannot reconnect: %s", self.queue, e)
+                        self.__fail_queued(e)
+                        if self.__closing.wait(reconnect_delay(failures)):
+                            break
+                        failures += 1
+                        continue
+
+                try:
+                    item = self.__messages.get(timeout=PIPELINE_IDLE_TIME)
+                except queue_module.Empty:
+                    try:
+                        self.connection.process_data_events(time_limit=0)
+                    except CONNECTION_ERRORS as e:
+                        logger.warning("Connection lost for queue %s, reconnecting: %s", self.queue, e)
+                        self.reconnect()
+                    continue
+
+                if item is None:
+                    break
+
+                method, corr_id, body, properties, future, caller, routing_key = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                try:
+                    self._send(method, corr_id, body, properties, routing_key)
+                    # La publish è attribuita al thread chiamante, non al thread di pubblicazione
+                    self.counters.increment(caller)
+                    future.set_result(corr_id)
+                except Exception as e:
+                    future.set_exception(e)
+            except Exception as e:
+                # Nessun errore deve fermare il thread: alla prossima iterazione la connessione viene ricreata
+                logger.exception("Publisher for queue %s failed: %s", self.queue, e)
+                if self.connection is not None and not self.connection.is_open:
+                    self.connection = None
+
+        self.__fail_queued(Exception("Publisher closed"))
+        try:
+            self.close_connection()
+        except Exception as e:
+            logger.warning("Impossibile chiudere il publisher della coda %s: %s", self.queue, e)
 
+    def __fail_queued(self, error: Exception):
+        # I messaggi rimasti in coda non saranno pubblicati: i chiamanti ricevono subito l'errore
+        while True:
+            try:
+                item = self.__messages.get_nowait()
+            except queue_module.Empty:
+                return
+            if item is not None and item[4].set_running_or_notify_cancel():
+                item[4].set_exception(error)
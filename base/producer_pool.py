@@ -0,0 +1,129 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from core.amqp.base.log import get_logger
+from core.amqp.base.producer import AMQPProducer
+
+logger = get_logger(__name__)
+
+# Secondi di inattività dopo i quali un producer del pool viene chiuso
+POOL_IDLE_TIMEOUT = 60
+# Numero massimo di producer inattivi mantenuti per ciascuna coda
+POOL_MAX_IDLE_PER_QUEUE = 8
+
+
+class AMQPProducerPool:
+    """
+    Pool di producer a lunga vita, indicizzati per coda di destinazione.
+
+    Ogni producer ha la propria connessione e viene usato da un solo thread alla volta:
+    acquire lo preleva dal pool (o ne crea uno nuovo) e lo restituisce al termine.
+    Le dichiarazioni di exchange, coda e binding sono eseguite una sola volta per coda.
+    """
+
+    def __init__(self, routing_key: str, confirm_delivery: bool = False, idle_timeout: float = POOL_IDLE_TIMEOUT, max_idle_per_queue: int = POOL_MAX_IDLE_PER_QUEUE):
+        self.routing_key = routing_key
+        self.confirm_delivery = confirm_delivery
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_queue = max_idle_per_queue
+
+        self.__lock = threading.Lock()
+        self.__idle = {}
+        self.__declared = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def acquire(self, queue: str):
+        producer = self.__checkout(queue)
+        try:
+            yield producer
+        except Exception:
+            # Lo stato della connessione non è più affidabile: il producer non torna nel pool
+            self.__close([producer])
+            raise
+        else:
+            self.__checkin(queue, producer)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "idle": sum(len(idle) for idle in self.__idle.values()),
+                "queues": len(self.__declared)
+            }
+
+    def close(self):
+        with self.__lock:
+            producers = [producer for idle in self.__idle.values() for producer, _ in idle]
+            self.__idle.clear()
+        self.__close(producers)
+
+    def __checkout(self, queue: str) -> AMQPProducer:
+        with self.__lock:
+            expired = self.__pop_expired(time.monotonic())
+            idle = self.__idle.get(queue, [])
+
+            producer = None
+            while idle:
+                candidate, _ = idle.pop()
+                if candidate.connection is not None and candidate.connection.is_open:
+                    producer = candidate
+                    break
+                expired.append(candidate)
+
+            if producer is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            declare = queue not in self.__declared
+
+        self.__close(expired)
+
+        if producer is None:
+            producer = AMQPProducer(
+                queue=queue,
+                routing_key=self.routing_key,
+                confirm_delivery=self.confirm_delivery,
+                declare=declare
+            )
+            producer.start_messanger()
+            with self.__lock:
+                self.__declared.add(queue)
+
+        return producer
+
+    def __checkin(self, queue: str, producer: AMQPProducer):
+        now = time.monotonic()
+        with self.__lock:
+            expired = self.__pop_expired(now)
+            idle = self.__idle.setdefault(queue, [])
+            if len(idle) < self.max_idle_per_queue:
+                idle.append((producer, now))
+            else:
+                expired.append(producer)
+
+        self.__close(expired)
+
+    def __pop_expired(self, now: float) -> list:
+        # Da chiamare con il lock acquisito
+        expired = []
+        for queue, idle in self.__idle.items():
+            alive = [(producer, last_used) for producer, last_used in idle if now - last_used < self.idle_timeout]
+            if len(alive) != len(idle):
+                expired.extend(producer for producer, last_used in idle if now - last_used >= self.idle_timeout)
+                self.__idle[queue] = alive
+        self.evictions += len(expired)
+        return expired
+
+    def __close(self, producers: list):
+        for producer in producers:
+            try:
+                producer.close_connection()
+            except Exception as e:
+                logger.warning("Impossibile chiudere il producer della coda %s: %s", producer.queue, e)
@@ -1,17 +1,38 @@
 from ast import Dict
 from enum import Enum
 import os
-import sys
 from time import sleep
 import uuid
 import collections
+from threading import Lock
 import pika
 
+from core.amqp.base.cipher import decompress
 from core.amqp.base.consumer import AMQPConsumer
-from core.amqp.base.producer import AMQPProducer
+from core.amqp.base.log import get_logger
+from core.amqp.base.pending_replies import AMQPPendingReplies
+from core.amqp.base.producer import AMQPPipelinedProducer, AMQPProducer
+from core.amqp.base.producer_pool import AMQPProducerPool
+from core.amqp.model.payload import REQUEST_METHODS
 
 collections.Callable = collections.abc.Callable
 
+logger = get_logger(__name__)
+
+# Header delle richieste per cui il chiamante non attende risposta: il microservizio non la pubblica
+HEADER_NO_REPLY = "x-no-reply"
+# Header con l'istante (epoch in secondi) oltre il quale il chiamante non attende più la risposta
+HEADER_DEADLINE = "x-deadline"
+# Secondi di tolleranza sulla scadenza, per le differenze tra gli orologi di client e server
+DEADLINE_CLOCK_SKEW = 1
+
+
+def route_by_method_enabled() -> bool:
+    """
+    Con BBSENDER_ROUTE_BY_METHOD=1 client e server usano una coda per metodo: la stessa variabile configura entrambi i lati.
+    """
+    return os.environ.get("BBSENDER_ROUTE_BY_METHOD") == "1"
+
 # Questo file gestisce la trasmissione dei dati e la gestione degli eventi di ritorno, derivanti dal corretto salvataggio degli stessi
 # - Trasmette la lista dei customers leggi dal CSV al consumer del microservizio customers
 # - Riceve la risposta dal microservizio customers
@@ -27,8 +48,13 @@ class AMQPProviderType(Enum):
 class AMQPProvider():
     
     instances = {}
+    instances_lock = Lock()
     
-    def __init__(self, consumer_queue: str, producer_queue: str, has_producer: bool = True):
+    def __init__(self, consumer_queue: str, producer_queue: str, has_producer: bool = True, pipelined: bool = False, confirm_delivery: bool = False, prefetch_count: int = None, manual_ack: bool = False, route_by_method: bool = False):
+        """
+        :param route_by_method: Se True ogni metodo è pubblicato sulla propria coda (producer_queue_<metodo>),
+            così un arretrato di un metodo lento non ritarda gli altri. Il server deve consumare le code per metodo.
+        """
         # Questa coda descrive i dati richiesti al microservizio
         self.consumer_queue = consumer_queue
         self.consumer_queue_rk = consumer_queue + '_rk'
@@ -37,19 +63,34 @@ class AMQPProvider():
         self.producer_queue = producer_queue
         self.producer_queue_rk = producer_queue + '_rk'
 
-        self.response_dict = {}    
+        # Risposte attese dai chiamanti, completate da data_received_response
+        self.pending_replies = AMQPPendingReplies()
         
         self.consumer = AMQPConsumer(
             queue=self.consumer_queue,
             routing_key=self.consumer_queue_rk,
-            callback=self.data_received_response
+            callback=self.data_received_response,
+            prefetch_count=prefetch_count,
+            manual_ack=manual_ack,
+            on_connection_lost=self.connection_lost
         )
         
         self.has_producer = has_producer
+        self.confirm_delivery = confirm_delivery
         if has_producer:
-            self.producer = AMQPProducer(
+            # In modalità pipelined le publish sono eseguite da un thread dedicato e restituiscono un Future
+            producer_class = AMQPPipelinedProducer if pipelined else AMQPProducer
+            self.producer = producer_class(
                 queue=self.producer_queue,
-                routing_key=self.producer_queue_rk
+                routing_key=self.producer_queue_rk,
+                confirm_delivery=confirm_delivery,
+                methods=tuple(amqp_method.value for amqp_method in REQUEST_METHODS) if route_by_method else ()
+            )
+        else:
+            # Lato server le risposte sono pubblicate su producer riutilizzati, uno per coda di origine
+            self.reply_pool = AMQPProducerPool(
+                routing_key=self.producer_queue_rk,
+                confirm_delivery=confirm_delivery
             )
         
         
@@ -59,41 +100,65 @@ class AMQPProvider():
         return AMQPProvider.instances.get(amqp_provider_type)
 
     @staticmethod
-    def create_istance(consumer_queue: str, producer_queue: str, amqp_provider_type: AMQPProviderType):
-        if AMQPProvider.get_instance(amqp_provider_type) is None:
-            # AMQPProvider.instances[amqp_provider_type] = AMQPProvider(consumer_queue, producer_queue)
-            istance = AMQPProvider(consumer_queue, producer_queue)
-            AMQPProvider.instances[amqp_provider_type] = istance
+    def create_istance(consumer_queue: str, producer_queue: str, amqp_provider_type: AMQPProviderType, pipelined: bool = True, route_by_method: bool = False):
+        # L'istanza è condivisa da tutti i thread: di default le publish passano dal thread dedicato del producer pipelined
+        with AMQPProvider.instances_lock:
+            if AMQPProvider.get_instance(amqp_provider_type) is None:
+                # AMQPProvider.instances[amqp_provider_type] = AMQPProvider(consumer_queue, producer_queue)
+                istance = AMQPProvider(consumer_queue, producer_queue, pipelined=pipelined, route_by_method=route_by_method)
+                AMQPProvider.instances[amqp_provider_type] = istance
 
         return AMQPProvider.get_instance(amqp_provider_type)
   
     def data_received_response(self, ch, method, props, body):
-        self.response_dict[props.correlation_id] = body.decode("utf-8")
+        # La risposta può essere compressa con la codifica negoziata nella richiesta
+        body = decompress(body, props.content_encoding)
+        if not self.pending_replies.resolve(props.correlation_id, body):
+            logger.debug("No caller waiting for response with uuid %s", props.correlation_id)
         
             
+    def connection_lost(self, error: Exception):
+        # Le risposte attese potrebbero non arrivare più: i chiamanti ricevono subito un errore invece di attendere il timeout
+        failed = self.pending_replies.fail_all(ConnectionError(f"Connessione persa sulla coda {self.consumer_queue}: {error}"))
+        if failed:
+            logger.warning("Failed %d pending requests after connection loss on %s", failed, self.consumer_queue)
+    
     def provide_listening(self):
         try:
             self.consumer.start_messanger()
             self.consumer.listen()
         except Exception as e:
-            print(e, file=sys.stderr)
+            logger.exception("Listener for queue %s stopped: %s", self.consumer_queue, e)
+        finally:
             self.consumer.close_connection()
     
+    def stop_listening(self):
+        self.consumer.stop()
+    
+    def cancel_listening(self) -> bool:
+        """
+        Smette di ricevere nuove richieste senza chiudere la connessione, ad esempio prima di un drain.
+        """
+        return self.consumer.cancel()
+    
     def provide_publishing(self):
         try:
             self.producer.start_messanger()
         except Exception as e:
-            print(e, file=sys.stderr)
+            logger.exception("Publisher for queue %s stopped: %s", self.producer_queue, e)
             self.producer.close_connection()
     
-    def publish(self, origin: str, method: str, body: str, corr_id: str):
+    def publish_stats(self) -> dict:
+        """
+        Publish eseguite da ciascun thread e relativo throughput (messaggi al secondo).
+        """
         if self.has_producer:
-            self.producer.publish(origin, method, corr_id, body)
+            return self.producer.counters.snapshot()
+        return {}
+    
+    def publish(self, origin: str, method: str, body: str, corr_id: str, properties: dict = None):
+        if self.has_producer:
+            return self.producer.publish(method, corr_id, body, properties)
         else:
-            producer = AMQPProducer(
-                queue=self.producer_queue + "_" + origin,
-                routing_key=self.producer_queue_rk
-            )
-            producer.start_messanger()
-            producer.publish(origin, method, corr_id, body)
-            producer.close_connection()
+            with self.reply_pool.acquire(self.producer_queue + "_" + origin) as producer:
+                producer.publish(method, corr_id, body, properties)
@@ -0,0 +1,100 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Thread di default per i metodi senza un limite dedicato
+DEFAULT_MAX_WORKERS = 8
+# Numero massimo di richieste in carico al processo (in esecuzione o in attesa di un thread)
+DEFAULT_MAX_PENDING = 64
+
+
+class AMQPRequestExecutor:
+    """
+    Esecutore limitato per la gestione delle richieste ricevute dal consumer.
+
+    Ogni metodo può avere un proprio numero massimo di thread (ad esempio pochi SEND_EMAIL
+    in parallelo e molti READ_FILE); gli altri metodi condividono il pool di default.
+    Ogni pool ha un proprio limite di richieste in carico (in esecuzione o in attesa di un thread):
+    quando è raggiunto, submit blocca il thread della connessione. Con manual_ack il prefetch è
+    prefetch_count, quindi le consegne successive restano nel broker; senza, il broker continua
+    a inviarle e si accumulano nel buffer della connessione.
+
+    Le richieste di un metodo non occupano i posti degli altri pool, ma tutti i metodi ricevuti
+    dallo stesso consumer condividono il suo thread: quando il pool di SEND_EMAIL è pieno,
+    anche le consegne READ_FILE successive attendono. L'isolamento tra i metodi richiede le code
+    per metodo (route_by_method di ConcreteAMQPProvider), ognuna con un proprio consumer ed esecutore.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, max_pending: int = DEFAULT_MAX_PENDING, method_limits: dict = None, method_pending: dict = None):
+        """
+        :param max_pending: Richieste in carico al pool di default.
+        :param method_limits: AMQPMethod -> thread del pool dedicato al metodo.
+        :param method_pending: AMQPMethod -> richieste in carico al pool dedicato, di default max_pending.
+        """
+        method_limits = method_limits or {}
+        method_pending = method_pending or {}
+        self.__default_slots = threading.BoundedSemaphore(max_pending)
+        self.__method_slots = {
+            method: threading.BoundedSemaphore(method_pending.get(method, max_pending))
+            for method in method_limits
+        }
+        # Il prefetch deve coprire i posti di tutti i pool, altrimenti un metodo esaurirebbe la finestra del broker
+        self.max_pending = max_pending + sum(method_pending.get(method, max_pending) for method in method_limits)
+        self.__counters_lock = threading.Lock()
+        self.__submitted = 0
+        self.__completed = 0
+        self.__started_at = time.monotonic()
+
+        self.__default_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="amqp-worker")
+        self.__executors = {
+            method: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"amqp-worker-{method.value}")
+            for method, limit in method_limits.items()
+        }
+
+    @property
+    def prefetch_count(self) -> int:
+        """
+        Prefetch da impostare sul consumer, pari al numero di richieste che l'esecutore può tenere in carico.
+        """
+        return self.max_pending
+
+    def submit(self, method, fn: callable, *args) -> Future:
+        slots = self.__method_slots.get(method, self.__default_slots)
+        slots.acquire()
+
+        executor = self.__executors.get(method, self.__default_executor)
+        try:
+            future = executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+
+        with self.__counters_lock:
+            self.__submitted += 1
+        future.add_done_callback(lambda _: self.__done(slots))
+        return future
+
+    def stats(self) -> dict:
+        """
+        Richieste accettate, completate e in carico, con il throughput medio dalla creazione (richieste al secondo).
+        """
+        with self.__counters_lock:
+            submitted = self.__submitted
+            completed = self.__completed
+        elapsed = time.monotonic() - self.__started_at
+        return {
+            "submitted": submitted,
+            "completed": completed,
+            "in_flight": submitted - completed,
+            "rate": completed / elapsed if elapsed > 0 else 0.0
+        }
+
+    def __done(self, slots: threading.BoundedSemaphore):
+        with self.__counters_lock:
+            self.__completed += 1
+        slots.release()
+
+    def shutdown(self, wait: bool = True):
+        self.__default_executor.shutdown(wait=wait)
+        for executor in self.__executors.values():
+            executor.shutdown(wait=wait)
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import deque
+from tempfile import SpooledTemporaryFile
+
+from core.amqp.base.consumer import AMQPConsumer
+from core.amqp.base.log import get_logger
+
+logger = get_logger(__name__)
+
+# Numero di sequenza del chunk (0 per il primo) e indicazione dell'ultimo chunk dello stream
+HEADER_STREAM_SEQ = "x-stream-seq"
+HEADER_STREAM_LAST = "x-stream-last"
+# Inviato dal client per chiedere una risposta in streaming, con la dimensione dei chunk
+HEADER_STREAM_ACCEPT = "x-stream-accept"
+# Campo di file_settings che contiene il contenuto del file in base64
+HEADER_STREAM_FIELD = "x-stream-field"
+# Coda dedicata allo stream, consumata da un solo destinatario
+HEADER_STREAM_QUEUE = "x-stream-queue"
+
+STREAM_CHUNK_SIZE = 256 * 1024
+STREAM_CONTENT_FIELD = "content"
+# Chunk consegnati al destinatario e non ancora elaborati (prefetch della coda dello stream)
+STREAM_WINDOW = 8
+# Byte mantenuti in memoria durante la ricomposizione, oltre i quali lo stream passa su file temporaneo
+STREAM_SPOOL_SIZE = 8 * 1024 * 1024
+# Secondi di attesa di un chunk dopo i quali uno stream incompleto viene scartato
+STREAM_TIMEOUT = 300
+
+
+def stream_queue(queue: str, corr_id: str) -> str:
+    """
+    Coda temporanea di uno stream: viene eliminata dal destinatario a stream concluso,
+    oppure dal broker se resta inutilizzata per STREAM_TIMEOUT secondi.
+    """
+    return f"{queue}_stream_{corr_id}"
+
+
+def stream_queue_arguments() -> dict:
+    return {"x-expires": STREAM_TIMEOUT * 1000}
+
+
+def stream_headers(seq: int, last: bool, headers: dict = None) -> dict:
+    stream = dict(headers or {})
+    stream[HEADER_STREAM_SEQ] = seq
+    stream[HEADER_STREAM_LAST] = last
+    return stream
+
+
+def iter_chunks(source, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    Suddivide in chunk di al più chunk_size byte un bytes, un file aperto in binario o un iterabile di bytes.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+        return
+
+    if hasattr(source, "read"):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    for block in source:
+        for chunk in iter_chunks(block, chunk_size):
+            yield chunk
+
+
+class AMQPStreamAssembler:
+    """
+    Ricompone uno stream di chunk, anche se consegnati fuori ordine da thread diversi.
+
+    I chunk sono scritti in ordine su un file temporaneo che resta in memoria fino a
+    STREAM_SPOOL_SIZE byte; quelli arrivati in anticipo attendono il proprio turno.
+    Il chunk 0 contiene l'intestazione dello stream e viene conservato a parte.
+    """
+
+    def __init__(self):
+        self.header = None
+        self.content_field = STREAM_CONTENT_FIELD
+        self.file = SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE)
+
+        self.__lock = threading.Lock()
+        self.__next_seq = 0
+        self.__early = {}
+        self.__last_seq = None
+
+    def add(self, seq: int, last: bool, data: bytes) -> bool:
+        """
+        :return: True se lo stream è completo.
+        """
+        with self.__lock:
+            if last:
+                self.__last_seq = seq
+            self.__early[seq] = data
+
+            while self.__next_seq in self.__early:
+                chunk = self.__early.pop(self.__next_seq)
+                if self.__next_seq == 0:
+                    self.header = chunk
+                else:
+                    self.file.write(chunk)
+                self.__next_seq += 1
+
+            complete = self.__last_seq is not None and self.__next_seq > self.__last_seq
+            if complete:
+                self.file.seek(0)
+            return complete
+
+    def close(self):
+        self.file.close()
+
+
+class AMQPStreamReceiver(AMQPConsumer):
+    """
+    Riceve i messaggi di uno stream dalla sua coda dedicata, con una connessione propria
+    servita dal thread che legge lo stream.
+
+    Il broker consegna al più window messaggi non confermati e ciascun messaggio è confermato
+    quando il chiamante chiede il successivo: se il chiamante è più lento del mittente i chunk
+    restano nel broker, quindi la memoria del destinatario resta costante.
+    """
+
+    def __init__(self, queue: str, window: int = STREAM_WINDOW):
+        self.__received = deque()
+        super().__init__(
+            queue=queue,
+            routing_key=queue + "_rk",
+            callback=self.__on_message,
+            prefetch_count=window,
+            manual_ack=True,
+            queue_arguments=stream_queue_arguments()
+        )
+
+    def receive(self, timeout: float):
+        """
+        Generatore dei messaggi dello stream come coppie (properties, body), in ordine di pubblicazione.
+
+        :param timeout: Secondi massimi di attesa tra un messaggio e il successivo.
+        """
+        while True:
+            deadline = time.monotonic() + timeout
+            while not self.__received:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception("Timeout")
+                self.connection.process_data_events(time_limit=remaining)
+
+            channel, delivery_tag, props, body = self.__received.popleft()
+            yield props, body
+            self.ack(delivery_tag, channel=channel)
+
+    def close(self):
+        """
+        Elimina la coda dello stream e chiude la connessione; i messaggi non letti vengono scartati.
+        """
+        try:
+            if self.channel is not None and self.channel.is_open:
+                self.channel.queue_delete(queue=self.queue)
+        except Exception as e:
+            logger.warning("Impossibile eliminare la coda %s: %s", self.queue, e)
+        self.close_connection()
+
+    def __on_message(self, ch, method, props, body):
+        self.__received.append((ch, method.delivery_tag, props, body))
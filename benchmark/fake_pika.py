@@ -0,0 +1,242 @@
+import itertools
+import queue
+import threading
+from collections import defaultdict, deque
+
+
+class FakeMethod:
+    def __init__(self, delivery_tag: int, routing_key: str):
+        self.delivery_tag = delivery_tag
+        self.routing_key = routing_key
+
+
+class FakeFrame:
+    def __init__(self, method):
+        self.method = method
+
+
+class FakeQueueDeclareOk:
+    def __init__(self, queue: str, message_count: int):
+        self.queue = queue
+        self.message_count = message_count
+
+
+class FakeBroker:
+    """
+    Broker in memoria con exchange di tipo direct, compatibile con la parte di pika.BlockingConnection
+    usata da AbstractMessanger. Si installa con AbstractMessanger.connection_factory = broker.connect.
+
+    Come in pika, le consegne sono eseguite dal thread che chiama process_data_events sulla connessione
+    del consumer. I consumer con conferma manuale ricevono al più prefetch_count messaggi non confermati;
+    quelli non confermati alla chiusura del canale, o rifiutati con requeue, tornano in testa alla coda.
+    I publisher confirms sono accettati ma non hanno effetto.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__bindings = defaultdict(set)
+        self.__backlog = defaultdict(deque)
+        self.__consumers = defaultdict(list)
+        self.__round_robin = defaultdict(itertools.count)
+        # canale -> delivery tag -> (coda, routing key, body, properties) dei messaggi non confermati
+        self.__unacked = defaultdict(dict)
+
+        self.published = 0
+        self.delivered = 0
+
+    def connect(self, parameters=None):
+        return FakeBlockingConnection(self)
+
+    def declare(self, queue_name: str):
+        with self.__lock:
+            self.__backlog[queue_name]
+
+    def delete(self, queue_name: str):
+        with self.__lock:
+            self.__backlog.pop(queue_name, None)
+            self.__consumers.pop(queue_name, None)
+            for queues in self.__bindings.values():
+                queues.discard(queue_name)
+
+    def depth(self, queue_name: str) -> int:
+        with self.__lock:
+            return len(self.__backlog.get(queue_name, ()))
+
+    def bind(self, queue_name: str, routing_key: str):
+        with self.__lock:
+            self.__bindings[routing_key].add(queue_name)
+
+    def consume(self, queue_name: str, channel, callback: callable, auto_ack: bool):
+        with self.__lock:
+            self.__consumers[queue_name].append((channel, callback, auto_ack))
+            self.__drain(queue_name)
+
+    def cancel(self, channel):
+        with self.__lock:
+            for queue_name, consumers in self.__consumers.items():
+                self.__consumers[queue_name] = [consumer for consumer in consumers if consumer[0] is not channel]
+
+    def close(self, channel):
+        with self.__lock:
+            for queue_name, consumers in self.__consumers.items():
+                self.__consumers[queue_name] = [consumer for consumer in consumers if consumer[0] is not channel]
+            unacked = self.__unacked.pop(channel, {})
+            for delivery_tag in sorted(unacked, reverse=True):
+                self.__requeue(unacked[delivery_tag])
+
+    def settle(self, channel, delivery_tag: int, multiple: bool, requeue: bool):
+        with self.__lock:
+            unacked = self.__unacked[channel]
+            delivery_tags = [tag for tag in unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+            for tag in sorted(delivery_tags, reverse=True):
+                message = unacked.pop(tag, None)
+                if message is not None and requeue:
+                    self.__requeue(message)
+
+            for queue_name, consumers in self.__consumers.items():
+                if any(consumer[0] is channel for consumer in consumers):
+                    self.__drain(queue_name)
+
+    def publish(self, routing_key: str, body: bytes, properties):
+        with self.__lock:
+            self.published += 1
+            for queue_name in self.__bindings.get(routing_key, ()):
+                self.__backlog[queue_name].append((routing_key, body, properties))
+                self.__drain(queue_name)
+
+    def __requeue(self, message: tuple):
+        # Da chiamare con il lock acquisito
+        queue_name, routing_key, body, properties = message
+        if queue_name in self.__backlog:
+            self.__backlog[queue_name].appendleft((routing_key, body, properties))
+            self.__drain(queue_name)
+
+    def __drain(self, queue_name: str):
+        # Da chiamare con il lock acquisito: consegna i messaggi in attesa ai consumer con prefetch disponibile
+        backlog = self.__backlog[queue_name]
+        while backlog:
+            consumer = self.__next_consumer(queue_name)
+            if consumer is None:
+                return
+            channel, callback, auto_ack = consumer
+            routing_key, body, properties = backlog.popleft()
+            delivery_tag = channel.next_delivery_tag()
+            if not auto_ack:
+                self.__unacked[channel][delivery_tag] = (queue_name, routing_key, body, properties)
+            self.delivered += 1
+            channel.enqueue_delivery(callback, delivery_tag, routing_key, body, properties, auto_ack)
+
+    def __next_consumer(self, queue_name: str):
+        # Da chiamare con il lock acquisito
+        consumers = self.__consumers.get(queue_name) or []
+        for _ in range(len(consumers)):
+            channel, callback, auto_ack = consumers[next(self.__round_robin[queue_name]) % len(consumers)]
+            if auto_ack or not channel.prefetch_count or len(self.__unacked[channel]) < channel.prefetch_count:
+                return channel, callback, auto_ack
+        return None
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.prefetch_count = 0
+        self.cancelled = False
+        self.__delivery_tags = itertools.count(1)
+
+    def exchange_declare(self, exchange: str, exchange_type: str = "direct", **kwargs):
+        pass
+
+    def queue_declare(self, queue: str, passive: bool = False, **kwargs):
+        if not passive:
+            self.broker.declare(queue)
+        return FakeFrame(FakeQueueDeclareOk(queue, self.broker.depth(queue)))
+
+    def queue_bind(self, exchange: str, queue: str, routing_key: str = None, **kwargs):
+        self.broker.bind(queue, routing_key)
+
+    def queue_delete(self, queue: str, **kwargs):
+        self.broker.delete(queue)
+
+    def basic_qos(self, prefetch_count: int = 0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_consume(self, queue: str, on_message_callback: callable, auto_ack: bool = False, **kwargs):
+        self.broker.consume(queue, self, on_message_callback, auto_ack)
+        return f"ctag-{id(self)}"
+
+    def basic_cancel(self, consumer_tag: str = None):
+        self.cancelled = True
+        self.broker.cancel(self)
+
+    def basic_publish(self, exchange: str, routing_key: str, body, properties=None, mandatory: bool = False):
+        self.broker.publish(routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False):
+        self.broker.settle(self, delivery_tag, multiple, False)
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True):
+        self.broker.settle(self, delivery_tag, multiple, requeue)
+
+    def next_delivery_tag(self) -> int:
+        return next(self.__delivery_tags)
+
+    def enqueue_delivery(self, callback: callable, delivery_tag: int, routing_key: str, body: bytes, properties, auto_ack: bool):
+        method = FakeMethod(delivery_tag, routing_key)
+
+        def deliver():
+            # Le consegne di un canale chiuso nel frattempo sono già tornate in coda; come in pika,
+            # quelle non ancora eseguite alla cancellazione del consumer sono rifiutate e tornano in coda
+            if not self.is_open:
+                return
+            if self.cancelled:
+                if not auto_ack:
+                    self.broker.settle(self, delivery_tag, False, True)
+                return
+            callback(self, method, properties, body)
+
+        self.connection.add_callback_threadsafe(deliver)
+
+    def close(self):
+        if self.is_open:
+            self.broker.close(self)
+        self.is_open = False
+
+
+class FakeBlockingConnection:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+        self.is_open = True
+        self.__events = queue.SimpleQueue()
+        self.__channels = []
+
+    def channel(self):
+        channel = FakeChannel(self)
+        self.__channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback: callable):
+        self.__events.put(callback)
+
+    def process_data_events(self, time_limit: float = 0):
+        try:
+            callback = self.__events.get(timeout=time_limit) if time_limit else self.__events.get_nowait()
+        except queue.Empty:
+            return
+
+        callback()
+        while True:
+            try:
+                callback = self.__events.get_nowait()
+            except queue.Empty:
+                return
+            callback()
+
+    def close(self):
+        for channel in self.__channels:
+            channel.close()
+        self.is_open = False
@@ -0,0 +1,236 @@
+"""
+Benchmark del percorso RPC: AMQPService (client) -> ConcreteAMQPProvider (server) con worker fittizi.
+
+Di default usa il broker in memoria di fake_pika, quindi non serve RabbitMQ; con --broker rabbitmq
+usa il broker configurato tramite le variabili RABBITMQ_*.
+
+Esempio, dalla root del progetto:
+
+    python -m core.amqp.benchmark.run_benchmark --concurrency 1,8,32 --payload-sizes 128,16384 \
+        --mix send_email:3,read_file:1 --output bench_results.json
+
+I risultati sono salvati in JSON insieme al commit corrente, per confrontare commit diversi.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+
+from cryptography.fernet import Fernet
+
+from core.amqp.amqp_service import AMQPService
+from core.amqp.base.abstract_messanger import AbstractMessanger
+from core.amqp.base.log import setup_logging
+from core.amqp.base.provider import AMQPProvider
+from core.amqp.base.request_executor import AMQPRequestExecutor
+from core.amqp.benchmark.fake_pika import FakeBroker
+from core.amqp.concrete_provider import ConcreteAMQPProvider, amqp_handler
+from core.amqp.model.payload import AMQPMethod, AMQPResponse, AMQPStatus
+
+BENCHMARK_ORIGIN = "bench"
+REQUEST_QUEUE = "bbsender_request"
+RESPONSE_QUEUE = "bbsender_response"
+
+# Variabili richieste da AbstractMessanger, irrilevanti con il broker in memoria
+FAKE_BROKER_ENV = {
+    "RABBITMQ_USER": "guest",
+    "RABBITMQ_PASS": "guest",
+    "RABBITMQ_HOSTNAME": "localhost",
+    "RABBITMQ_PORT": "5672",
+    "RABBITMQ_EXCHANGE": "bbsender_benchmark",
+}
+
+
+class PassthroughSettingsDecoder:
+    """
+    Sostituisce AMQPSettingsDecoder: i worker fittizi ricevono il body così com'è.
+    """
+    def decode(self, body) -> dict:
+        return dict(body.__dict__)
+
+
+def register_stub_handlers(methods: list, worker_time: float):
+    """
+    Registra per ogni metodo un gestore che simula il lavoro del worker con una sleep.
+    """
+    def make_handler(amqp_method: AMQPMethod):
+        def handler(settings: dict) -> AMQPResponse:
+            if worker_time:
+                time.sleep(worker_time)
+            return AMQPResponse(amqp_method, AMQPStatus.OK, "OK")
+        return handler
+
+    for amqp_method in methods:
+        amqp_handler(amqp_method)(make_handler(amqp_method))
+
+
+def parse_int_list(value: str) -> list:
+    return [int(item) for item in value.split(",") if item]
+
+
+def parse_mix(value: str) -> list:
+    """
+    "send_email:3,read_file:1" -> [(AMQPMethod.SEND_EMAIL, 3), (AMQPMethod.READ_FILE, 1)]
+    """
+    mix = []
+    for item in value.split(","):
+        name, _, weight = item.partition(":")
+        mix.append((AMQPMethod(name.strip()), float(weight or 1)))
+    return mix
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def start_thread(target: callable, name: str) -> threading.Thread:
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
+def run_scenario(service: AMQPService, concurrency: int, payload_size: int, mix: list, requests: int, timeout: float, seed: int) -> dict:
+    """
+    Esegue le richieste distribuite su `concurrency` thread e misura la latenza di ogni chiamata.
+    """
+    methods = [amqp_method for amqp_method, _ in mix]
+    weights = [weight for _, weight in mix]
+    payload = "x" * payload_size
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_thread = [requests // concurrency + (1 if index < requests % concurrency else 0) for index in range(concurrency)]
+
+    def caller(index: int):
+        rng = random.Random(seed + index)
+        local_latencies = []
+        local_errors = 0
+        for amqp_method in rng.choices(methods, weights, k=per_thread[index]):
+            started = time.perf_counter()
+            response = service.connect_and_get_data(amqp_method, timeout=timeout, payload=payload)
+            local_latencies.append(time.perf_counter() - started)
+            if response.status != AMQPStatus.OK:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=caller, args=(index,)) for index in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "payload_size": payload_size,
+        "mix": {amqp_method.value: weight for amqp_method, weight in mix},
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark RPC AMQPService -> ConcreteAMQPProvider")
+    parser.add_argument("--broker", choices=["memory", "rabbitmq"], default="memory")
+    parser.add_argument("--concurrency", type=parse_int_list, default=[1, 8, 32])
+    parser.add_argument("--payload-sizes", type=parse_int_list, default=[128, 16384])
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("send_email:1"))
+    parser.add_argument("--requests", type=int, default=2000, help="Richieste per scenario")
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--worker-time", type=float, default=0.0, help="Secondi di lavoro simulato per richiesta")
+    parser.add_argument("--compression", choices=["zlib", "zstd"], default=None)
+    parser.add_argument("--route-by-method", action="store_true", help="Una coda e un esecutore per ciascun metodo")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="File JSON in cui salvare i risultati")
+    args = parser.parse_args()
+    setup_logging()
+
+    os.environ["BBSENDER_ORIGIN"] = BENCHMARK_ORIGIN
+    os.environ.setdefault("BBSENDER_ENCRYPT_KEY", Fernet.generate_key().decode())
+    if args.broker == "memory":
+        for key, value in FAKE_BROKER_ENV.items():
+            os.environ.setdefault(key, value)
+        AbstractMessanger.connection_factory = FakeBroker().connect
+
+    register_stub_handlers([amqp_method for amqp_method, _ in args.mix], args.worker_time)
+
+    method_executors = {amqp_method: AMQPRequestExecutor() for amqp_method, _ in args.mix} if args.route_by_method else None
+    server = ConcreteAMQPProvider(consumer_queue=REQUEST_QUEUE, producer_queue=RESPONSE_QUEUE, method_executors=method_executors)
+    server.settings_decoder = PassthroughSettingsDecoder()
+    client = AMQPProvider(
+        consumer_queue=RESPONSE_QUEUE + "_" + BENCHMARK_ORIGIN,
+        producer_queue=REQUEST_QUEUE,
+        pipelined=True,
+        route_by_method=args.route_by_method
+    )
+
+    start_thread(server.provide_listening, "bench-server")
+    start_thread(client.provide_listening, "bench-client-listener")
+    client.provide_publishing()
+    service = AMQPService(client, compression=args.compression)
+
+    results = []
+    try:
+        run_scenario(service, 1, 128, args.mix, args.warmup, args.timeout, args.seed)
+        for payload_size in args.payload_sizes:
+            for concurrency in args.concurrency:
+                result = run_scenario(service, concurrency, payload_size, args.mix, args.requests, args.timeout, args.seed)
+                results.append(result)
+                print(
+                    f"concurrency={concurrency:<4} payload={payload_size:<8} "
+                    f"throughput={result['throughput']:>10.1f} req/s  "
+                    f"p50={result['p50_ms']:>8.3f} ms  p99={result['p99_ms']:>8.3f} ms  errors={result['errors']}"
+                )
+    finally:
+        client.stop_listening()
+        server.stop_listening()
+        client.producer.close_connection()
+        server.executor.shutdown()
+
+    if args.output:
+        report = {
+            "commit": current_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "broker": args.broker,
+            "worker_time": args.worker_time,
+            "compression": args.compression,
+            "route_by_method": args.route_by_method,
+            "results": results,
+        }
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
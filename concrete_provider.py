@@ -1,15 +1,27 @@
 
-import sys
+import base64
+import os
 import collections
-from threading import Thread
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from core.abstract.setting import Setting
 
-from core.amqp.base.provider import AMQPProvider
-from core.amqp.model.payload import AMQPBody, AMQPMethod, AMQPResponse, AMQPStatus
+from core.amqp.base.abstract_messanger import method_queue
+from core.amqp.base.consumer import AMQPConsumer
+from core.amqp.base.producer import AMQPProducer
+from core.amqp.base.instrumentation import ERRORS_TOTAL, EXPIRED_TOTAL, HEADER_SENT_AT, HEADER_TRACE_ID, IN_FLIGHT, QUEUE_DEPTH, STAGE_SECONDS, get_instrumentation
+from core.amqp.base.log import get_logger, truncate
+from core.amqp.base.cipher import AMQPPayloadCipher, HEADER_ACCEPT_ENCODING, compress, negotiate_encoding
+from core.amqp.base.provider import DEADLINE_CLOCK_SKEW, HEADER_DEADLINE, HEADER_NO_REPLY, AMQPProvider, route_by_method_enabled
+from core.amqp.base.request_executor import AMQPRequestExecutor
+from core.amqp.base.stream import AMQPStreamAssembler, AMQPStreamReceiver, HEADER_STREAM_ACCEPT, HEADER_STREAM_FIELD, HEADER_STREAM_LAST, HEADER_STREAM_QUEUE, HEADER_STREAM_SEQ, STREAM_CONTENT_FIELD, STREAM_TIMEOUT, iter_chunks, stream_headers
+from core.amqp.model.payload import AMQPBody, AMQPMethod, AMQPResponse, AMQPStatus, BATCH_METHODS, JSON_CODEC, REQUEST_METHODS
 
-import json
 from core.exception.external_exception import ExternalException
-from utility.fernet_utility import FernetUtility
+from core.amqp.result_cache import INVALIDATING_METHODS, AMQPCacheInvalidationBus, AMQPResultCache
+from core.amqp.settings_decoder import AMQPSettingsDecoder
+from core.amqp.worker_pool import AMQPWorkerPool
 from workers.delete_file_worker import DeleteFileWorker
 from workers.read_file_worker import ReadFileWorker
 from workers.save_file_worker import SaveFileWorker
@@ -18,95 +30,474 @@ from workers.send_notification_worker import SendNotificationWorker
 
 collections.Callable = collections.abc.Callable
 
+logger = get_logger(__name__)
+
+# Thread che eseguono in parallelo gli elementi delle richieste BATCH
+BATCH_MAX_WORKERS = 8
+
+# Metodo indicato nella content type -> AMQPMethod, calcolato una sola volta
+AMQP_METHODS = {amqp_method.value: amqp_method for amqp_method in AMQPMethod}
+
+# AMQPMethod -> funzione che riceve i settings e restituisce la AMQPResponse
+METHOD_HANDLERS = {}
+
+# Worker riutilizzati tra le richieste: SendMailWorker è indicizzato per smtp_settings e mantiene la connessione SMTP,
+# i worker dei file per file_settings senza il contenuto
+WORKER_POOL = AMQPWorkerPool()
+
+
+def amqp_handler(amqp_method: AMQPMethod):
+    """
+    Registra la funzione decorata come gestore del metodo AMQP.
+    """
+    def decorator(handler: callable):
+        METHOD_HANDLERS[amqp_method] = handler
+        return handler
+    return decorator
+
+
+@amqp_handler(AMQPMethod.SEND_EMAIL)
+def send_email(settings: dict) -> AMQPResponse:
+    with WORKER_POOL.acquire(SendMailWorker, settings, ("smtp_settings",)) as send_mail_worker:
+        send_mail_worker.handle_work()
+    return AMQPResponse(AMQPMethod.SEND_EMAIL, AMQPStatus.OK, "OK")
+
+
+@amqp_handler(AMQPMethod.SEND_NOTIFICATION)
+def send_notification(settings: dict) -> AMQPResponse:
+    with WORKER_POOL.acquire(SendNotificationWorker, settings) as send_notification_worker:
+        return send_notification_worker.handle_work()
+
+
+@amqp_handler(AMQPMethod.SAVE_FILE)
+def save_file(settings: dict) -> AMQPResponse:
+    with WORKER_POOL.acquire(SaveFileWorker, settings, ("file_settings",), (STREAM_CONTENT_FIELD,)) as save_file_worker:
+        return save_file_worker.handle_work()
+
+
+@amqp_handler(AMQPMethod.READ_FILE)
+def read_file(settings: dict) -> AMQPResponse:
+    with WORKER_POOL.acquire(ReadFileWorker, settings, ("file_settings",), (STREAM_CONTENT_FIELD,)) as read_file_worker:
+        return read_file_worker.handle_work()
+
+
+@amqp_handler(AMQPMethod.DELETE_FILE)
+def delete_file(settings: dict) -> AMQPResponse:
+    with WORKER_POOL.acquire(DeleteFileWorker, settings, ("file_settings",), (STREAM_CONTENT_FIELD,)) as delete_file_worker:
+        return delete_file_worker.handle_work()
+
+
 class ConcreteAMQPProvider(AMQPProvider):
-    def __init__(self, consumer_queue: str, producer_queue: str):
-        super().__init__(consumer_queue, producer_queue, has_producer=False)
+    def __init__(self, consumer_queue: str, producer_queue: str, executor: AMQPRequestExecutor = None, manual_ack: bool = False, result_cache: AMQPResultCache = None, method_executors: dict = None, route_by_method: bool = None):
+        """
+        :param method_executors: AMQPMethod -> AMQPRequestExecutor delle code per metodo; se indicato attiva route_by_method.
+        :param route_by_method: Se True il provider consuma anche la coda di ciascun metodo (client con route_by_method),
+            ognuna con un proprio esecutore, quindi con thread, richieste in carico e prefetch propri: i metodi
+            senza esecutore in method_executors ne ricevono uno con le dimensioni di default.
+            Di default segue BBSENDER_ROUTE_BY_METHOD, come i client.
+        """
+        # Le richieste sono eseguite da un pool limitato: a pool pieno la callback blocca il consumer,
+        # e solo con manual_ack (prefetch) le consegne successive restano nel broker
+        self.executor = executor if executor is not None else AMQPRequestExecutor()
+        # Cache opzionale delle risposte READ_FILE, invalidata da SAVE_FILE e DELETE_FILE di tutti i processi sulla stessa coda
+        self.result_cache = result_cache
+        self.cache_bus = AMQPCacheInvalidationBus(result_cache, consumer_queue) if result_cache is not None else None
+        self.settings_decoder = AMQPSettingsDecoder()
+        self.batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix="amqp-batch")
+        
+        # Con manual_ack il prefetch coincide con la capacità dell'esecutore e i messaggi sono confermati a gestione terminata
+        super().__init__(
+            consumer_queue,
+            producer_queue,
+            has_producer=False,
+            prefetch_count=self.executor.prefetch_count if manual_ack else None,
+            manual_ack=manual_ack
+        )
+        
+        if route_by_method is None:
+            route_by_method = method_executors is not None or route_by_method_enabled()
+        # Un esecutore per metodo: un budget condiviso lascerebbe che un arretrato di SEND_EMAIL blocchi READ_FILE
+        self.method_executors = {
+            amqp_method: (method_executors or {}).get(amqp_method) or AMQPRequestExecutor()
+            for amqp_method in (REQUEST_METHODS if route_by_method else ())
+        }
+        
+        # Un consumer per metodo, ciascuno con la propria connessione: un arretrato di SEND_EMAIL non ritarda READ_FILE
+        self.method_consumers = {}
+        for amqp_method, method_executor in self.method_executors.items():
+            queue = method_queue(consumer_queue, amqp_method.value)
+            self.method_consumers[amqp_method] = AMQPConsumer(
+                queue=queue,
+                routing_key=queue + "_rk",
+                callback=self.__method_callback(amqp_method, method_executor),
+                prefetch_count=method_executor.prefetch_count if manual_ack else None,
+                manual_ack=manual_ack,
+                on_connection_lost=self.connection_lost
+            )
+    
+    def __method_callback(self, amqp_method: AMQPMethod, executor: AMQPRequestExecutor):
+        def callback(ch, method, props, body):
+            consumer = self.method_consumers[amqp_method]
+            if self._drop_expired(ch, method, props, consumer):
+                return
+            self.__submit(executor, amqp_method, ch, method, props, body, consumer)
+        return callback
+    
+    def provide_listening(self):
+        consumers = list(self.method_consumers.values())
+        if self.cache_bus is not None:
+            self.cache_bus.producer.start_messanger()
+            consumers.append(self.cache_bus.consumer)
+        
+        threads = [
+            threading.Thread(target=self.__listen, args=(consumer,), name=f"amqp-listener-{consumer.queue}")
+            for consumer in consumers
+        ]
+        for thread in threads:
+            thread.start()
+        
+        super().provide_listening()
+        for thread in threads:
+            thread.join()
+        if self.cache_bus is not None:
+            self.cache_bus.producer.close_connection()
+    
+    def stop_listening(self):
+        for consumer in self.method_consumers.values():
+            consumer.stop()
+        if self.cache_bus is not None:
+            self.cache_bus.consumer.stop()
+        super().stop_listening()
+    
+    def cancel_listening(self) -> bool:
+        cancelled = [consumer.cancel() for consumer in self.method_consumers.values()]
+        return super().cancel_listening() and all(cancelled)
+    
+    def __listen(self, consumer: AMQPConsumer):
+        try:
+            consumer.start_messanger()
+            consumer.listen()
+        except Exception as e:
+            logger.exception("Listener for queue %s stopped: %s", consumer.queue, e)
+        finally:
+            consumer.close_connection()
+    
+    def queue_stats(self) -> dict:
+        """
+        Per ogni coda consumata: messaggi in attesa nel broker e richieste dell'esecutore che la serve.
+        La profondità è registrata anche nel gauge amqp_queue_depth.
+        """
+        consumers = [(self.consumer, self.executor)] + [
+            (consumer, self.method_executors[amqp_method])
+            for amqp_method, consumer in self.method_consumers.items()
+        ]
+        
+        stats = {}
+        for consumer, executor in consumers:
+            try:
+                depth = consumer.queue_depth()
+                get_instrumentation().set(QUEUE_DEPTH, depth, queue=consumer.queue)
+            except Exception as e:
+                logger.warning("Impossibile leggere la profondità della coda %s: %s", consumer.queue, e)
+                depth = None
+            stats[consumer.queue] = {"depth": depth, **executor.stats()}
+        return stats
     
     def data_received_response(self, ch, method, props, body):
-        thread = Thread(target=self._manage_data_response, args=(ch, method, props, body))
-        thread.start()
+        try:
+            _, amqp_method = self._get_data_from_content_type(props.content_type)
+        except ExternalException:
+            # L'errore viene gestito e notificato da _manage_data_response
+            amqp_method = None
+        
+        if self._drop_expired(ch, method, props, self.consumer):
+            return
+        self.__submit(self.executor, amqp_method, ch, method, props, body, self.consumer)
+    
+    def __submit(self, executor: AMQPRequestExecutor, amqp_method: AMQPMethod, ch, method, props, body, consumer: AMQPConsumer):
+        try:
+            executor.submit(amqp_method, self._handle_delivery, ch, method, props, body, consumer)
+        except RuntimeError as e:
+            # Esecutore già chiuso durante lo spegnimento: il messaggio torna in coda per un altro consumer
+            logger.warning("Richiesta %s rifiutata: %s", props.correlation_id, e)
+            if consumer.manual_ack:
+                consumer.nack(method.delivery_tag, requeue=True, channel=ch)
+    
+    def _drop_expired(self, ch, method, props, consumer: AMQPConsumer) -> bool:
+        """
+        Scarta la richiesta se il chiamante ha già smesso di attendere (header x-deadline).
+        Il controllo avviene prima di decifrare e di occupare un thread dell'esecutore.
+        """
+        try:
+            deadline = float((props.headers or {})[HEADER_DEADLINE])
+        except (KeyError, TypeError, ValueError):
+            return False
+        if time.time() <= deadline + DEADLINE_CLOCK_SKEW:
+            return False
+        
+        amqp_method = AMQP_METHODS.get((props.content_type or "").partition("|")[2])
+        get_instrumentation().increment(EXPIRED_TOTAL, side="server", method=amqp_method.value if amqp_method is not None else "unknown")
+        logger.debug("Richiesta %s scaduta, scartata", props.correlation_id)
+        if consumer.manual_ack:
+            consumer.ack(method.delivery_tag, channel=ch)
+        return True
+    
+    def _handle_delivery(self, ch, method, props, body, consumer: AMQPConsumer):
+        # La richiesta può essere scaduta durante l'attesa di un thread dell'esecutore
+        if self._drop_expired(ch, method, props, consumer):
+            return
+        
+        amqp_method = AMQP_METHODS.get((props.content_type or "").partition("|")[2])
+        method_label = amqp_method.value if amqp_method is not None else "unknown"
+        
+        instrumentation = get_instrumentation()
+        headers = props.headers or {}
+        if HEADER_SENT_AT in headers:
+            # Attesa nella coda del broker e nell'esecutore, per coda: mostra l'isolamento tra i metodi
+            instrumentation.observe(STAGE_SECONDS, time.time() - float(headers[HEADER_SENT_AT]), stage="queue_wait", method=method_label, queue=consumer.queue)
+        
+        try:
+            with instrumentation.in_flight(IN_FLIGHT, side="server", method=method_label):
+                self._manage_data_response(ch, method, props, body)
+        except Exception as e:
+            instrumentation.increment(ERRORS_TOTAL, side="server", stage="reply", method=method_label)
+            # La risposta non è stata pubblicata: il messaggio viene scartato per non rieseguire il worker in loop
+            logger.exception("Impossibile rispondere alla richiesta %s: %s", props.correlation_id, e)
+            if consumer.manual_ack:
+                consumer.nack(method.delivery_tag, requeue=False, channel=ch)
+        else:
+            if consumer.manual_ack:
+                consumer.ack(method.delivery_tag, channel=ch)
     
     def _manage_data_response(self, ch, method, props, body):
         try:
-            print("CORR_ID della richiesta: ", props.correlation_id, file=sys.stderr)
-            print("Risposta ricevuta", file=sys.stderr)
-            
             content_type = props.content_type
-            print("Content type: ", content_type, file=sys.stderr)
-            body_str = body.decode('utf-8')
+            logger.debug("Richiesta ricevuta: corr_id %s, content type %s", props.correlation_id, content_type)
             
             try:
-                decrypted_body = FernetUtility.decrypt_data(body)
+                origin, amqp_method = self._get_data_from_content_type(content_type)
+            except ExternalException as e:
+                raise e
+            
+            instrumentation = get_instrumentation()
+            headers = props.headers or {}
+            
+            # Il body è decifrato e decompresso direttamente dai bytes ricevuti, senza copie intermedie in str
+            try:
+                with instrumentation.timer(STAGE_SECONDS, stage="decrypt", method=amqp_method.value):
+                    cipher = AMQPPayloadCipher.for_key(os.environ.get("BBSENDER_ENCRYPT_KEY"))
+                    decrypted_body = cipher.decrypt(body, props.content_encoding)
             except Exception as e:
                 raise ExternalException("Errore: impossibile decifrare il body")
             
-            body_json = json.loads(decrypted_body)
+            # Il chunk 0 apre uno stream: i successivi sono letti dalla coda dello stream prima di eseguire il worker
+            if HEADER_STREAM_SEQ in headers:
+                self.manage_stream_save(origin, amqp_method, headers, decrypted_body, props.correlation_id)
+                return
+            
+            body_json = JSON_CODEC.loads(decrypted_body)
             
             amqp_body = AMQPBody(**body_json)
-            # print("BODY: ", amqp_body.__dict__, file=sys.stderr)
+            logger.debug("Body: %s", truncate(amqp_body.__dict__))
             
-            try:
-                origin, method = self._get_data_from_content_type(content_type)
-            except ExternalException as e:
-                raise e
+            if HEADER_STREAM_ACCEPT in headers and HEADER_STREAM_QUEUE in headers and amqp_method == AMQPMethod.READ_FILE:
+                content_field = headers.get(HEADER_STREAM_FIELD, STREAM_CONTENT_FIELD)
+                self.manage_stream_read(origin, amqp_body, props.correlation_id, int(headers[HEADER_STREAM_ACCEPT]), content_field, headers[HEADER_STREAM_QUEUE])
+                return
             
-            amqp_method = AMQPMethod(method)
+            accept_encoding = headers.get(HEADER_ACCEPT_ENCODING)
             
-            self.manage_data(origin, amqp_method, amqp_body, props.correlation_id)
+            self.manage_data(origin, amqp_method, amqp_body, props.correlation_id, accept_encoding, reply=not headers.get(HEADER_NO_REPLY))
             
         except ExternalException as e:
+            get_instrumentation().increment(ERRORS_TOTAL, side="server", stage="request", method=AMQPMethod.EXCEPTION.value)
             data = AMQPResponse(AMQPMethod.EXCEPTION, AMQPStatus.ERROR, e.message)
-            self.publish(origin, AMQPMethod.EXCEPTION.value, str(data), props.correlation_id)
+            self.__publish_error(origin, data, props)
         except Exception as e:
+            get_instrumentation().increment(ERRORS_TOTAL, side="server", stage="request", method=AMQPMethod.EXCEPTION.value)
             data = AMQPResponse(AMQPMethod.EXCEPTION, AMQPStatus.ERROR, "Errore: " + str(e))
-            self.publish(origin, AMQPMethod.EXCEPTION.value, str(data), props.correlation_id)
+            self.__publish_error(origin, data, props)
     
-    def manage_data(self, origin: str, amqp_method: AMQPMethod, amqp_body: AMQPBody, corr_id: str):
+    def __publish_error(self, origin: str, data: AMQPResponse, props):
+        if (props.headers or {}).get(HEADER_NO_REPLY):
+            logger.warning("Richiesta %s senza risposta fallita: %s", props.correlation_id, truncate(data))
+            return
+        self.publish_response(origin, AMQPMethod.EXCEPTION, data, props.correlation_id)
+    
+    def manage_data(self, origin: str, amqp_method: AMQPMethod, amqp_body: AMQPBody, corr_id: str, accept_encoding: str = None, reply: bool = True):
         """
         La funzione gestisce i dati in base al metodo e al provider
         In base al methodo e al provider, la funzione richiama la funzione get_data nel modo corretto
-        Il risultato è trasmesso al richiedente
+        Il risultato è trasmesso al richiedente, compresso se il richiedente accetta una codifica supportata
+        Con reply False (header x-no-reply) il richiedente non attende il risultato, che non viene pubblicato
         """
         data = self.get_data(amqp_method, amqp_body)
         
-        # print("Risposta: ", data, file=sys.stderr)
-        self.publish(origin, amqp_method.value, str(data), corr_id)
+        logger.debug("Risposta: %s", truncate(data))
+        if not reply:
+            if data is not None and data.status == AMQPStatus.ERROR:
+                logger.warning("Richiesta %s senza risposta fallita: %s", corr_id, truncate(data))
+            return
+        self.publish_response(origin, amqp_method, data, corr_id, accept_encoding)
+    
+    def publish_response(self, origin: str, amqp_method: AMQPMethod, data: AMQPResponse, corr_id: str, accept_encoding: str = None):
+        with get_instrumentation().timer(STAGE_SECONDS, stage="reply", method=amqp_method.value):
+            reply, content_encoding = compress(data.to_bytes(), negotiate_encoding(accept_encoding))
+            properties = {
+                "content_encoding": content_encoding,
+                "headers": {HEADER_TRACE_ID: corr_id}
+            }
+            self.publish(origin, amqp_method.value, reply, corr_id, properties=properties)
+    
+    def manage_stream_save(self, origin: str, amqp_method: AMQPMethod, headers: dict, data: bytes, corr_id: str):
+        """
+        La funzione ricompone uno stream SAVE_FILE
+        Il chunk 0, ricevuto dalla coda delle richieste, contiene le impostazioni e indica la coda dello stream:
+        i chunk successivi sono letti solo da lì, quindi l'intero stream è gestito da questo consumer
+        anche quando più processi o repliche consumano la stessa coda delle richieste
+        Al termine esegue il salvataggio e trasmette il risultato al richiedente
+        """
+        if amqp_method != AMQPMethod.SAVE_FILE or HEADER_STREAM_QUEUE not in headers:
+            raise ExternalException(f"Errore: streaming non supportato per {amqp_method.value}")
+        
+        cipher = AMQPPayloadCipher.for_key(os.environ.get("BBSENDER_ENCRYPT_KEY"))
+        assembler = AMQPStreamAssembler()
+        assembler.content_field = headers.get(HEADER_STREAM_FIELD, STREAM_CONTENT_FIELD)
+        assembler.add(0, False, data)
+        
+        receiver = AMQPStreamReceiver(headers[HEADER_STREAM_QUEUE])
+        try:
+            receiver.start_messanger()
+            for props, body in receiver.receive(STREAM_TIMEOUT):
+                chunk_headers = props.headers or {}
+                if assembler.add(int(chunk_headers[HEADER_STREAM_SEQ]), bool(chunk_headers.get(HEADER_STREAM_LAST)), cipher.decrypt(body)):
+                    break
+            
+            amqp_body = AMQPBody(**JSON_CODEC.loads(assembler.header))
+            response = self.save_file_stream(amqp_body, assembler.file, assembler.content_field)
+        finally:
+            receiver.close()
+            assembler.close()
+        
+        self.publish_response(origin, amqp_method, response, corr_id)
     
+    def save_file_stream(self, amqp_body: AMQPBody, file, content_field: str) -> AMQPResponse:
+        """
+        La funzione salva il contenuto di uno stream ricomposto
+        Se il worker espone handle_stream(file) il contenuto è scritto in modo incrementale,
+        altrimenti viene inserito in base64 in file_settings come in una richiesta normale
+        """
+        try:
+            if hasattr(SaveFileWorker, "handle_stream"):
+                settings = self.__get_settings(amqp_body)
+                cache_key = self.result_cache.key(amqp_body) if self.result_cache is not None else None
+                if cache_key is not None:
+                    self.cache_bus.invalidate(cache_key)
+                try:
+                    with WORKER_POOL.acquire(SaveFileWorker, settings, ("file_settings",), (STREAM_CONTENT_FIELD,)) as save_file_worker:
+                        return save_file_worker.handle_stream(file)
+                finally:
+                    if cache_key is not None:
+                        self.cache_bus.invalidate(cache_key)
+            
+            amqp_body.file_settings[content_field] = base64.b64encode(file.read()).decode("ascii")
+            return self.get_data(AMQPMethod.SAVE_FILE, amqp_body)
+        except Exception as e:
+            return AMQPResponse(AMQPMethod.SAVE_FILE, AMQPStatus.ERROR, "Errore: " + str(e))
+    
+    def manage_stream_read(self, origin: str, amqp_body: AMQPBody, corr_id: str, chunk_size: int, content_field: str, reply_queue: str):
+        """
+        La funzione legge un file e lo trasmette al richiedente in chunk cifrati singolarmente
+        I chunk sono pubblicati sulla coda dello stream indicata dal richiedente, che li consuma con un prefetch limitato
+        Se il worker espone handle_stream() i chunk sono letti in modo incrementale,
+        altrimenti il contenuto in base64 viene preso dal campo content_field della risposta
+        In caso di errore il richiedente riceve una risposta normale sulla stessa coda
+        """
+        # Il producer delle risposte del richiedente pubblica anche sulla coda dello stream, dichiarata dal richiedente:
+        # nessuna nuova connessione per stream e nessuna ridichiarazione della coda alla riconnessione
+        routing_key = reply_queue + "_rk"
+        with self.reply_pool.acquire(self.producer_queue + "_" + origin) as producer:
+            try:
+                settings = self.__get_settings(amqp_body)
+                with WORKER_POOL.acquire(ReadFileWorker, settings, ("file_settings",), (STREAM_CONTENT_FIELD,)) as read_file_worker:
+                    if hasattr(read_file_worker, "handle_stream"):
+                        self.__publish_stream(producer, routing_key, AMQPMethod.READ_FILE, corr_id, read_file_worker.handle_stream(), chunk_size)
+                        return
+                    response = read_file_worker.handle_work()
+                
+                if response.status != AMQPStatus.ERROR:
+                    content = self.__get_file_content(response.data, content_field)
+                    self.__publish_stream(producer, routing_key, AMQPMethod.READ_FILE, corr_id, base64.b64decode(content), chunk_size)
+                    return
+            except Exception as e:
+                response = AMQPResponse(AMQPMethod.READ_FILE, AMQPStatus.ERROR, "Errore: " + str(e))
+            
+            producer.publish(AMQPMethod.READ_FILE.value, corr_id, response.to_bytes(), {"headers": {HEADER_TRACE_ID: corr_id}}, routing_key)
+    
+    def __publish_stream(self, producer: AMQPProducer, routing_key: str, amqp_method: AMQPMethod, corr_id: str, source, chunk_size: int):
+        cipher = AMQPPayloadCipher.for_key(os.environ.get("BBSENDER_ENCRYPT_KEY"))
+        
+        seq = 0
+        for chunk in iter_chunks(source, chunk_size):
+            encrypted_chunk, _ = cipher.encrypt(chunk)
+            producer.publish(amqp_method.value, corr_id, encrypted_chunk, {"headers": stream_headers(seq, False)}, routing_key)
+            seq += 1
+        
+        encrypted_chunk, _ = cipher.encrypt(b"")
+        producer.publish(amqp_method.value, corr_id, encrypted_chunk, {"headers": stream_headers(seq, True)}, routing_key)
+    
+    def __get_file_content(self, data, content_field: str):
+        if isinstance(data, dict):
+            return data[content_field]
+        if hasattr(data, content_field):
+            return getattr(data, content_field)
+        return data
     
     def get_data(self, method: AMQPMethod, amqp_body: AMQPBody):
         """
         La funzione ritorna i dati in base al metodo e al provider
+        Il gestore del metodo è registrato in METHOD_HANDLERS tramite amqp_handler
         """
         try:
+            if method == AMQPMethod.BATCH:
+                return self.get_batch_data(amqp_body)
+            
+            handler = METHOD_HANDLERS.get(method)
+            if handler is None:
+                raise ExternalException(f"Metodo {method.value} non gestito")
+            
             """
                 Il body contiene al suo interno un json con le impostazioni
             """
             
-            settings = self.__get_settings(amqp_body)
-            response = None
+            # I settings sono decodificati e validati anche quando la risposta è in cache
+            instrumentation = get_instrumentation()
+            with instrumentation.timer(STAGE_SECONDS, stage="settings_decode", method=method.value):
+                settings = self.__get_settings(amqp_body)
             
-            if method == AMQPMethod.SEND_EMAIL:
-                send_mail_worker = SendMailWorker(settings=settings)
-                send_mail_worker.handle_work()
-                response = AMQPResponse(method, AMQPStatus.OK, "OK")
+            cache_key = self.result_cache.key(amqp_body) if self.result_cache is not None else None
+            if cache_key is not None and method == AMQPMethod.READ_FILE:
+                cached = self.result_cache.get(cache_key)
+                if cached is not None:
+                    return cached
+                generation = self.result_cache.begin()
+            elif cache_key is not None and method in INVALIDATING_METHODS:
+                # Invalidata prima e dopo la scrittura, anche negli altri processi: le letture concorrenti non salvano il contenuto precedente
+                self.cache_bus.invalidate(cache_key)
             
-            if method == AMQPMethod.SEND_NOTIFICATION:
-                send_notification_worker = SendNotificationWorker(settings=settings)
-                response = send_notification_worker.handle_work()
-                
-            if method == AMQPMethod.SAVE_FILE:
-                save_file_worker = SaveFileWorker(settings=settings)
-                response = save_file_worker.handle_work()
-            if method == AMQPMethod.READ_FILE:
-                read_file_worker = ReadFileWorker(settings=settings)
-                response = read_file_worker.handle_work()
-            if method == AMQPMethod.DELETE_FILE:
-                delete_file_worker = DeleteFileWorker(settings=settings)
-                response = delete_file_worker.handle_work()
+            try:
+                with instrumentation.timer(STAGE_SECONDS, stage="worker", method=method.value):
+                    response = handler(settings)
+            finally:
+                if cache_key is not None and method in INVALIDATING_METHODS:
+                    self.cache_bus.invalidate(cache_key)
             
+            if cache_key is not None and method == AMQPMethod.READ_FILE:
+                self.result_cache.put(cache_key, response, generation)
             return response
             
         except Exception as e:
+            get_instrumentation().increment(ERRORS_TOTAL, side="server", stage="worker", method=method.value)
             body = "Errore: " + str(e)
             response = AMQPResponse(method, AMQPStatus.ERROR, body)
             return response
@@ -115,26 +506,37 @@ class ConcreteAMQPProvider(AMQPProvider):
             response = AMQPResponse(method, AMQPStatus.ERROR, body)
             return response
         
-    def _get_data_from_content_type(self, content_type: str):
+    def get_batch_data(self, amqp_body: AMQPBody) -> AMQPResponse:
+        """
+        La funzione esegue in parallelo gli elementi di una richiesta BATCH
+        Restituisce una sola risposta con l'esito di ciascun elemento, nello stesso ordine della richiesta
+        """
         try:
+            method = AMQP_METHODS.get(getattr(amqp_body, "method", None))
+            if method not in BATCH_METHODS:
+                raise ExternalException("Errore: metodo non valido per il batch")
             
-            try:
-                origin = content_type.split("|")[0]
-                content_type_method = content_type.split("|")[1]
-            except Exception as e:
-                raise ExternalException("Errore: content type non valido")
+            items = getattr(amqp_body, "items", [])
+            responses = self.batch_executor.map(lambda item: self.get_data(method, AMQPBody(**item)), items)
             
-            methods = [key.lower() for key, value in AMQPMethod.__members__.items()]
+            data = []
+            for response in responses:
+                if response is None:
+                    response = AMQPResponse(method, AMQPStatus.OK, None)
+                data.append(response)
             
-            method_found = None
-            for method in methods:
-                try:
-                    if content_type_method == method:
-                        method_found = method
-                        break
-                except ValueError:
-                    continue
+            return AMQPResponse(AMQPMethod.BATCH, AMQPStatus.OK, data)
+        except ExternalException as e:
+            return AMQPResponse(AMQPMethod.BATCH, AMQPStatus.ERROR, "Errore: " + str(e))
+    
+    def _get_data_from_content_type(self, content_type: str):
+        try:
+            
+            origin, separator, content_type_method = content_type.partition("|")
+            if not separator:
+                raise ExternalException("Errore: content type non valido")
             
+            method_found = AMQP_METHODS.get(content_type_method)
             if method_found is None:
                 raise ExternalException("Errore: metodo non valido")
             
@@ -156,47 +558,11 @@ class ConcreteAMQPProvider(AMQPProvider):
             
             Può esistere un solo oggetto per ogni classe
             Se ne esistono più di uno, viene restituito un errore
+            
+            La decodifica è delegata ad AMQPSettingsDecoder, che compila lo schema una sola volta
         """
         try:
-            from core.models.smtp_settings import SMTPSettings
-            from core.models.mail_settings import MailSettings
-            from core.models.file_settings import FileSettings
-            from core.models.notification_settings import NotificationSettings
-            
-            return_dict = {}
-            
-            allowed_settings = {
-                "smtp_settings": "SMTPSettings",
-                "mail_settings": "MailSettings",
-                "file_settings": "FileSettings",
-                "notification_settings": "NotificationSettings"
-            }
-            
-            for key, value in body.__dict__.items():
-                if key in allowed_settings.keys():
-                    class_name = allowed_settings[key]
-                    try:
-                        setting_class_name = globals()[class_name]
-                    except KeyError as e:
-                        print(e, file=sys.stderr)
-                        setting_class_name = locals()[class_name]
-                    
-                    if setting_class_name is None:
-                        raise ExternalException(f"La classe {class_name} non esiste")
-                    
-                    if setting_class_name is not None:
-                        try:
-                            setting_object = setting_class_name(value)
-                        except TypeError as e:
-                            raise ExternalException(f"Errore: {e}")
-                        
-                        if class_name in return_dict.keys():
-                            raise ExternalException(f"Esiste già un oggetto {class_name}")        
-                        return_dict[key] = setting_object
-                else:
-                    raise ExternalException(f"{key} non è un setting valido")
-            
-            return return_dict
+            return self.settings_decoder.decode(body)
         except ExternalException as e:
-            print(e, file=sys.stderr)
-            raise e
+            logger.warning("Settings non validi: %s", e)
+            raise e
\ No newline at end of file
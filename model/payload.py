@@ -3,6 +3,44 @@ import json
 
 from core.abstract.json_serializable import JsonSerializable
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class AMQPJsonCodec:
+    """
+    Codifica JSON dei payload AMQP basata sulla libreria standard. Produce e accetta bytes.
+    """
+    name = "json"
+    
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    
+    def loads(self, data):
+        return json.loads(data)
+
+
+class AMQPOrjsonCodec(AMQPJsonCodec):
+    """
+    Codifica JSON basata su orjson; i valori che orjson non supporta (ad esempio interi oltre 64 bit) usano la libreria standard.
+    """
+    name = "orjson"
+    
+    def dumps(self, value) -> bytes:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            return super().dumps(value)
+    
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+# Codec usato da client e server: orjson se installato, altrimenti la libreria standard
+JSON_CODEC = AMQPOrjsonCodec() if orjson is not None else AMQPJsonCodec()
+
 class AMQPMethod(Enum):
     EXCEPTION                   = "exception"
     
@@ -14,6 +52,15 @@ class AMQPMethod(Enum):
     
     SEND_NOTIFICATION           = "send_notification"
     
+    # Busta con N richieste dello stesso metodo, con una risposta per elemento
+    BATCH                       = "batch"
+    
+# Metodi che possono essere inviati in una busta BATCH
+BATCH_METHODS = frozenset([AMQPMethod.SEND_EMAIL, AMQPMethod.SEND_NOTIFICATION])
+
+# Metodi delle richieste: con l'instradamento per metodo ognuno ha la propria coda
+REQUEST_METHODS = tuple(amqp_method for amqp_method in AMQPMethod if amqp_method != AMQPMethod.EXCEPTION)
+
 class AMQPBody():
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
@@ -23,6 +70,9 @@ class AMQPBody():
     def to_json(self):
         return json.dumps(self.__dict__)
     
+    def to_bytes(self) -> bytes:
+        return JSON_CODEC.dumps(self.__dict__)
+    
 class AMQPStatus(Enum):
     OK = "ok"
     ERROR = "error"
@@ -55,9 +105,34 @@ class AMQPResponse:
             return_dict["data"] = self.data
             
         return return_dict
+    
+    def to_bytes(self) -> bytes:
+        """
+        Serializza la risposta in un solo passaggio.
         
-        
+        Il JSON prodotto da un JsonSerializable e le risposte annidate (BATCH) sono inseriti così come sono,
+        senza essere codificati di nuovo come stringa.
+        """
+        return b'{"method":' + JSON_CODEC.dumps(self.method.value) + b',"status":' + JSON_CODEC.dumps(self.status.value) + b',"data":' + self.__data_to_bytes(self.data) + b'}'
+    
+    @staticmethod
+    def from_bytes(data) -> "AMQPResponse":
+        response_dict = JSON_CODEC.loads(data)
+        return AMQPResponse(AMQPMethod(response_dict["method"]), AMQPStatus(response_dict["status"]), response_dict["data"])
+    
+    @staticmethod
+    def __data_to_bytes(data) -> bytes:
+        if isinstance(data, AMQPResponse):
+            return data.to_bytes()
+        if isinstance(data, list) and data and all(isinstance(item, AMQPResponse) for item in data):
+            return b"[" + b",".join(item.to_bytes() for item in data) + b"]"
+        if isinstance(data, JsonSerializable):
+            serialized = data.to_json()
+            if isinstance(serialized, str):
+                return serialized.encode("utf-8")
+            return JSON_CODEC.dumps(serialized)
+        return JSON_CODEC.dumps(data)
     
     def __str__(self):
-        return json.dumps(self.to_json())
+        return self.to_bytes().decode("utf-8")
     
\ No newline at end of file
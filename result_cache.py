@@ -0,0 +1,229 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from core.amqp.base.consumer import AMQPConsumer
+from core.amqp.base.log import get_logger
+from core.amqp.base.producer import AMQPProducer
+from core.amqp.base.stream import STREAM_CONTENT_FIELD
+from core.amqp.model.payload import AMQPBody, AMQPMethod, AMQPResponse, AMQPStatus
+from core.amqp.settings_decoder import settings_digest
+
+# Byte massimi occupati dalle risposte in cache
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Secondi dopo i quali una risposta in cache non viene più restituita
+RESULT_CACHE_TTL = 300
+# Numero di invalidazioni ricordate per scartare le letture iniziate prima di una scrittura
+INVALIDATION_MEMORY = 10000
+
+# Metodi che modificano un file e invalidano le letture in cache
+INVALIDATING_METHODS = frozenset([AMQPMethod.SAVE_FILE, AMQPMethod.DELETE_FILE])
+
+# Metodo indicato nella content type dei messaggi di invalidazione
+CACHE_INVALIDATION_METHOD = "cache_invalidation"
+# Secondi per cui il broker conserva la coda di invalidazione di un processo non connesso:
+# le invalidazioni pubblicate durante una disconnessione più breve vengono consegnate alla riconnessione
+CACHE_INVALIDATION_QUEUE_EXPIRES = 600
+
+logger = get_logger(__name__)
+
+
+class AMQPResultCache:
+    """
+    Cache delle risposte READ_FILE, indicizzate per identità del file (file_settings senza il contenuto)
+    e per gli altri campi della richiesta (ad esempio credenziali o tenant), che possono cambiare la risposta.
+
+    La cache è limitata in byte con eliminazione LRU e ogni risposta scade dopo ttl secondi.
+    SAVE_FILE e DELETE_FILE invalidano la chiave del file: una lettura iniziata prima dell'invalidazione
+    non viene salvata (vedi begin/put), quindi non è mai restituito un contenuto già sovrascritto.
+
+    Di per sé vede solo le scritture dello stesso processo: lato server più repliche devono condividere
+    le invalidazioni tramite AMQPCacheInvalidationBus, lato client le modifiche fatte da altri
+    client diventano visibili al più dopo ttl secondi.
+    """
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_MAX_BYTES, ttl: float = RESULT_CACHE_TTL, excluded_fields: tuple = (STREAM_CONTENT_FIELD,)):
+        """
+        :param excluded_fields: Campi di file_settings che non identificano il file (ad esempio il contenuto di SAVE_FILE).
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.excluded_fields = frozenset(excluded_fields)
+
+        self.__lock = threading.Lock()
+        # chiave -> (risposta, byte, istante di inserimento), in ordine di utilizzo
+        self.__entries = OrderedDict()
+        # file -> chiavi in cache delle richieste su quel file, rimosse insieme all'invalidazione
+        self.__files = {}
+        self.__bytes = 0
+        # file -> generazione dell'ultima invalidazione; i file dimenticati usano __floor
+        self.__generation = 0
+        self.__invalidated = OrderedDict()
+        self.__floor = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def key(self, amqp_body: AMQPBody):
+        """
+        :return: Coppia (file, richiesta): il file è usato per le invalidazioni, la richiesta per le letture.
+            None se il body non contiene file_settings.
+        """
+        file_settings = getattr(amqp_body, "file_settings", None)
+        if not isinstance(file_settings, dict):
+            return None
+        file_settings = {field: value for field, value in file_settings.items() if field not in self.excluded_fields}
+        return settings_digest(file_settings), settings_digest({**vars(amqp_body), "file_settings": file_settings})
+
+    def begin(self) -> int:
+        """
+        Da chiamare prima di leggere il file: il valore va passato a put.
+        """
+        with self.__lock:
+            return self.__generation
+
+    def get(self, key) -> AMQPResponse:
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            response, size, stored_at = entry
+            if now - stored_at >= self.ttl:
+                self.__remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key, response: AMQPResponse, generation: int):
+        """
+        Salva una risposta READ_FILE riuscita, a meno che il file sia stato invalidato dopo begin.
+        """
+        if response is None or response.status != AMQPStatus.OK:
+            return
+
+        size = len(response.to_bytes())
+        if size > self.max_bytes:
+            return
+
+        with self.__lock:
+            if generation < self.__invalidated.get(key[0], self.__floor):
+                return
+
+            self.__remove(key)
+            self.__entries[key] = (response, size, time.monotonic())
+            self.__files.setdefault(key[0], set()).add(key)
+            self.__bytes += size
+            while self.__bytes > self.max_bytes:
+                self.__remove(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Invalida tutte le letture in cache del file della chiave, qualunque siano gli altri campi della richiesta.
+        """
+        self.invalidate_file(key[0])
+
+    def invalidate_file(self, file_key):
+        with self.__lock:
+            self.__generation += 1
+            for key in list(self.__files.get(file_key, ())):
+                self.__remove(key)
+            self.__invalidated[file_key] = self.__generation
+            self.__invalidated.move_to_end(file_key)
+            if len(self.__invalidated) > INVALIDATION_MEMORY:
+                # Le letture iniziate prima dell'invalidazione dimenticata vengono scartate per tutte le chiavi
+                _, self.__floor = self.__invalidated.popitem(last=False)
+            self.invalidations += 1
+
+    def clear(self):
+        """
+        Svuota la cache e scarta le letture in corso, ad esempio quando alcune invalidazioni potrebbero essere andate perse.
+        """
+        with self.__lock:
+            self.__generation += 1
+            self.__floor = self.__generation
+            self.__invalidated.clear()
+            self.__entries.clear()
+            self.__files.clear()
+            self.__bytes = 0
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "entries": len(self.__entries),
+                "bytes": self.__bytes
+            }
+
+    def __remove(self, key):
+        # Da chiamare con il lock acquisito
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.__bytes -= entry[1]
+            keys = self.__files[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.__files[key[0]]
+
+
+class AMQPCacheInvalidationBus:
+    """
+    Propaga le invalidazioni di una AMQPResultCache a tutti i processi server che consumano la stessa coda.
+
+    Ogni processo ha una propria coda collegata alla stessa routing key dell'exchange direct, quindi
+    un'invalidazione pubblicata da un processo raggiunge tutti gli altri, che la applicano alla propria cache.
+    Le altre repliche vedono una scrittura con il ritardo di consegna del messaggio; se la connessione
+    del bus cade la cache locale viene svuotata, perché le invalidazioni potrebbero essere andate perse.
+    """
+
+    def __init__(self, cache: AMQPResultCache, consumer_queue: str):
+        """
+        :param consumer_queue: Coda delle richieste del server: i processi che la consumano condividono le invalidazioni.
+        """
+        self.cache = cache
+        routing_key = consumer_queue + "_cache_invalidation_rk"
+        queue = f"{consumer_queue}_cache_invalidation_{uuid.uuid4().hex}"
+
+        # Consumer e producer dichiarano la coda con gli stessi argomenti: alla riconnessione entrambi la ridichiarano
+        queue_arguments = {"x-expires": CACHE_INVALIDATION_QUEUE_EXPIRES * 1000}
+        self.consumer = AMQPConsumer(
+            queue=queue,
+            routing_key=routing_key,
+            callback=self.__invalidation_received,
+            on_connection_lost=self.__connection_lost,
+            queue_arguments=queue_arguments
+        )
+        self.producer = AMQPProducer(queue=queue, routing_key=routing_key, declare=False, queue_arguments=queue_arguments)
+
+    def invalidate(self, key):
+        """
+        Invalida la chiave nella cache locale e la notifica agli altri processi.
+        """
+        self.cache.invalidate(key)
+        try:
+            self.producer.publish(CACHE_INVALIDATION_METHOD, None, key[0])
+        except Exception as e:
+            logger.warning("Cache invalidation not propagated, other replicas may serve stale reads for up to %s s: %s", self.cache.ttl, e)
+
+    def __invalidation_received(self, ch, method, props, body):
+        self.cache.invalidate_file(body)
+
+    def __connection_lost(self, error):
+        logger.warning("Cache invalidation bus disconnected, clearing the result cache: %s", error)
+        self.cache.clear()
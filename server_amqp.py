@@ -1,8 +1,10 @@
 import os
-import sys
 from threading import Thread
 
-from core.amqp.base.provider import AMQPProvider, AMQPProviderType
+from core.amqp.base.log import get_logger, setup_logging
+from core.amqp.base.provider import AMQPProvider, AMQPProviderType, route_by_method_enabled
+
+logger = get_logger(__name__)
 
 
 class AMQPServer:
@@ -23,18 +25,22 @@ class AMQPServer:
         #     producer_queue="bbsender_request",
         #     is_consumer_responding=False,
         # )
+        # Con BBSENDER_ROUTE_BY_METHOD=1 ogni metodo ha la propria coda, consumata dal server con la stessa variabile
         provider = AMQPProvider.create_istance(
             consumer_queue="bbsender_response" + "_" + origin,
             producer_queue="bbsender_request",
-            amqp_provider_type=AMQPProviderType.BBSENDER
+            amqp_provider_type=AMQPProviderType.BBSENDER,
+            route_by_method=route_by_method_enabled()
         )
-        print("AMQPProvider created", file=sys.stderr)
+        logger.info("AMQPProvider created")
         return provider
 
     def get_amqp_provider(self):
         return self.__amqp_provider
 
     def start_amqp_server(self):
+        # Il logging a coda del pacchetto è configurato dal processo del server, come in AMQPShardedServer
+        setup_logging()
         thread_listener = Thread(target=self.__amqp_provider.provide_listening)
         thread_publisher = Thread(target=self.__amqp_provider.provide_publishing)
         
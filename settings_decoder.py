@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+from core.amqp.model.payload import AMQPBody
+from core.exception.external_exception import ExternalException
+
+# Numero massimo di oggetti settings mantenuti in cache
+SETTINGS_CACHE_SIZE = 1024
+# Settings che si ripetono quasi identici tra le richieste e vengono quindi messi in cache
+CACHED_SETTINGS = ("smtp_settings",)
+
+
+def settings_digest(value) -> bytes:
+    """
+    Impronta del contenuto di un setting, indipendente dall'ordine delle chiavi.
+    I valori non serializzabili in JSON sono confrontati come stringa.
+    """
+    serialized = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    return hashlib.blake2b(serialized, digest_size=16).digest()
+
+
+class AMQPSettingsDecoder:
+    """
+    Decodifica dei settings contenuti nel body della richiesta.
+
+    Lo schema (chiave del body -> classe del setting) è compilato una sola volta, al primo utilizzo,
+    e gli oggetti delle chiavi in CACHED_SETTINGS sono riutilizzati finché il contenuto non cambia.
+    Gli oggetti in cache sono condivisi tra le richieste e non devono essere modificati dai worker.
+    """
+
+    def __init__(self, cache_size: int = SETTINGS_CACHE_SIZE, cached_settings: tuple = CACHED_SETTINGS):
+        self.cache_size = cache_size
+        self.cached_settings = frozenset(cached_settings)
+
+        self.__decoders = None
+        self.__lock = threading.Lock()
+        self.__cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, body: AMQPBody) -> dict:
+        decoders = self.__decoders if self.__decoders is not None else self.__compile()
+
+        return_dict = {}
+        for key, value in body.__dict__.items():
+            decoder = decoders.get(key)
+            if decoder is None:
+                raise ExternalException(f"{key} non è un setting valido")
+
+            if key in self.cached_settings:
+                return_dict[key] = self.__decode_cached(key, decoder, value)
+            else:
+                return_dict[key] = self.__decode(decoder, value)
+
+        return return_dict
+
+    def __compile(self) -> dict:
+        # Import ritardati al primo messaggio, come in origine, per evitare import circolari con core.models
+        from core.models.smtp_settings import SMTPSettings
+        from core.models.mail_settings import MailSettings
+        from core.models.file_settings import FileSettings
+        from core.models.notification_settings import NotificationSettings
+
+        self.__decoders = {
+            "smtp_settings": SMTPSettings,
+            "mail_settings": MailSettings,
+            "file_settings": FileSettings,
+            "notification_settings": NotificationSettings
+        }
+        return self.__decoders
+
+    def __decode(self, decoder: type, value):
+        try:
+            return decoder(value)
+        except (TypeError, ValueError, KeyError) as e:
+            raise ExternalException(f"Errore: {e}")
+
+    def __decode_cached(self, key: str, decoder: type, value):
+        cache_key = (key, settings_digest(value))
+
+        with self.__lock:
+            setting_object = self.__cache.get(cache_key)
+            if setting_object is not None:
+                self.__cache.move_to_end(cache_key)
+                self.hits += 1
+                return setting_object
+            self.misses += 1
+
+        setting_object = self.__decode(decoder, value)
+
+        with self.__lock:
+            self.__cache[cache_key] = setting_object
+            if len(self.__cache) > self.cache_size:
+                self.__cache.popitem(last=False)
+
+        return setting_object
@@ -0,0 +1,226 @@
+import multiprocessing
+import os
+import queue as queue_module
+import signal
+import threading
+import time
+
+from core.amqp.base.abstract_messanger import reconnect_delay
+from core.amqp.base.log import get_logger, setup_logging
+from core.amqp.base.provider import route_by_method_enabled
+from core.amqp.base.request_executor import DEFAULT_MAX_PENDING, DEFAULT_MAX_WORKERS, AMQPRequestExecutor
+from core.amqp.concrete_provider import ConcreteAMQPProvider
+from core.amqp.model.payload import REQUEST_METHODS
+
+logger = get_logger(__name__)
+
+# Secondi tra due invii delle statistiche di un processo al supervisore
+SHARD_STATS_INTERVAL = 5
+# Secondi concessi ai processi per completare le richieste in carico prima di essere terminati
+SHARD_DRAIN_TIMEOUT = 30
+# Secondi tra due controlli dello stato dei processi
+SUPERVISOR_POLL_INTERVAL = 1
+# Un processo rimasto attivo almeno questi secondi azzera il backoff dei riavvii
+SHARD_STABLE_TIME = 60
+
+
+def _shard_stats(executors: list) -> dict:
+    """
+    Statistiche del processo: somma di quelle del suo esecutore e degli eventuali esecutori per metodo.
+    """
+    stats = [executor.stats() for executor in executors]
+    return {key: sum(executor_stats[key] for executor_stats in stats) for key in stats[0]}
+
+
+def _run_shard(shard: int, consumer_queue: str, producer_queue: str, max_workers: int, max_pending: int, manual_ack: bool, route_by_method: bool, method_workers: dict, stats_queue, stop_event):
+    """
+    Corpo di un processo figlio: un ConcreteAMQPProvider con connessione, prefetch ed esecutore propri.
+    Gli esecutori sono creati nel figlio: dal supervisore arrivano solo le dimensioni.
+    """
+    # Ctrl+C arriva a tutto il gruppo di processi: lo gestisce il supervisore, che ferma i figli in ordine
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+    executor = AMQPRequestExecutor(max_workers=max_workers, max_pending=max_pending)
+    # Con route_by_method ogni coda per metodo ha un esecutore proprio, di default con le dimensioni di quello del processo
+    method_executors = {
+        amqp_method: AMQPRequestExecutor(*method_workers.get(amqp_method, (max_workers, max_pending)))
+        for amqp_method in (REQUEST_METHODS if route_by_method else ())
+    }
+    executors = [executor, *method_executors.values()]
+    provider = ConcreteAMQPProvider(consumer_queue, producer_queue, executor=executor, manual_ack=manual_ack, method_executors=method_executors, route_by_method=route_by_method)
+
+    listener = threading.Thread(target=provider.provide_listening, name=f"amqp-shard-{shard}")
+    listener.start()
+
+    while listener.is_alive() and not stop_event.wait(SHARD_STATS_INTERVAL):
+        stats_queue.put((shard, os.getpid(), _shard_stats(executors)))
+
+    crashed = not stop_event.is_set()
+    if not crashed:
+        # Drain: nessuna nuova consegna, le richieste in carico terminano e vengono confermate prima della chiusura
+        logger.info("Shard %d draining %d requests", shard, _shard_stats(executors)["in_flight"])
+        if not provider.cancel_listening():
+            logger.warning("Shard %d could not cancel its consumers, deliveries may still arrive", shard)
+        for shard_executor in executors:
+            shard_executor.shutdown(wait=True)
+
+    # listen invia le conferme ancora in sospeso prima di terminare
+    provider.stop_listening()
+    listener.join()
+    provider.reply_pool.close()
+    stats_queue.put((shard, os.getpid(), _shard_stats(executors)))
+
+    if crashed:
+        raise SystemExit(1)
+
+
+class AMQPShardedServer:
+    """
+    Server multi-processo: il supervisore avvia N processi figli che consumano la stessa coda delle richieste.
+
+    Ogni processo ha la propria connessione, il proprio prefetch e il proprio GIL, quindi decifratura,
+    parsing JSON e worker sfruttano più core. I processi terminati in modo anomalo vengono riavviati
+    con backoff; in chiusura ciascun processo smette di ricevere e completa le richieste in carico.
+    """
+
+    def __init__(self, consumer_queue: str, producer_queue: str, processes: int = None, max_workers: int = DEFAULT_MAX_WORKERS, max_pending: int = DEFAULT_MAX_PENDING, manual_ack: bool = True, route_by_method: bool = None, method_workers: dict = None):
+        """
+        :param processes: Numero di processi figli, di default il numero di core.
+        :param max_workers: Thread di ciascun processo per la gestione delle richieste.
+        :param max_pending: Richieste in carico a ciascun processo, usato anche come prefetch.
+        :param manual_ack: Se True i messaggi sono confermati a gestione terminata e quelli di un processo caduto vengono riconsegnati.
+        :param route_by_method: Se True ogni processo consuma anche le code per metodo (client con BBSENDER_ROUTE_BY_METHOD=1),
+            ciascuna con un esecutore proprio. Di default segue BBSENDER_ROUTE_BY_METHOD.
+        :param method_workers: AMQPMethod -> (max_workers, max_pending) dell'esecutore del metodo in ciascun processo;
+            i metodi non indicati usano max_workers e max_pending. Usato solo con route_by_method.
+        """
+        self.consumer_queue = consumer_queue
+        self.producer_queue = producer_queue
+        self.processes = processes or os.cpu_count() or 1
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.manual_ack = manual_ack
+        self.route_by_method = route_by_method if route_by_method is not None else route_by_method_enabled()
+        self.method_workers = dict(method_workers or {})
+
+        # fork dove disponibile: i figli ereditano la configurazione senza reimportare l'applicazione
+        start_methods = multiprocessing.get_all_start_methods()
+        self.__context = multiprocessing.get_context("fork" if "fork" in start_methods else None)
+        self.__stats_queue = self.__context.Queue()
+        self.__stopping = threading.Event()
+
+        # shard -> (processo, evento di stop, istante di avvio)
+        self.__shards = {}
+        self.__restart_at = {}
+        self.__restarts = [0] * self.processes
+        self.__failures = [0] * self.processes
+        self.__stats = {}
+
+    def start(self):
+        for shard in range(self.processes):
+            self.__spawn(shard)
+        logger.info("Started %d shards on queue %s", self.processes, self.consumer_queue)
+
+    def serve_forever(self):
+        """
+        Avvia i processi e li supervisiona finché non viene chiamato stop o ricevuto SIGTERM/SIGINT, poi esegue il drain.
+        Il supervisore è il processo principale del server, quindi configura anche il logging a coda del pacchetto.
+        """
+        setup_logging()
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        signal.signal(signal.SIGINT, lambda *_: self.stop())
+
+        if not self.__shards:
+            self.start()
+
+        while not self.__stopping.wait(SUPERVISOR_POLL_INTERVAL):
+            self.__collect_stats()
+            self.__check_shards()
+
+        self.__drain()
+
+    def stop(self):
+        """
+        Chiede al supervisore di fermare i processi. Può essere chiamato da qualsiasi thread o da un signal handler.
+        """
+        self.__stopping.set()
+
+    def stats(self) -> dict:
+        """
+        Statistiche dell'ultimo invio di ciascun processo e totali aggregati; il throughput totale è la somma dei processi.
+        """
+        self.__collect_stats()
+
+        shards = {}
+        for shard in range(self.processes):
+            shards[shard] = {**self.__stats.get(shard, {}), "restarts": self.__restarts[shard]}
+
+        return {
+            "shards": shards,
+            "total": {
+                "processes": self.processes,
+                "completed": sum(stats.get("completed", 0) for stats in shards.values()),
+                "in_flight": sum(stats.get("in_flight", 0) for stats in shards.values()),
+                "rate": sum(stats.get("rate", 0.0) for stats in shards.values()),
+                "restarts": sum(self.__restarts)
+            }
+        }
+
+    def __spawn(self, shard: int):
+        stop_event = self.__context.Event()
+        process = self.__context.Process(
+            target=_run_shard,
+            args=(shard, self.consumer_queue, self.producer_queue, self.max_workers, self.max_pending, self.manual_ack, self.route_by_method, self.method_workers, self.__stats_queue, stop_event),
+            name=f"amqp-shard-{shard}",
+            daemon=False
+        )
+        process.start()
+        self.__shards[shard] = (process, stop_event, time.monotonic())
+
+    def __check_shards(self):
+        now = time.monotonic()
+        for shard, (process, _, started_at) in list(self.__shards.items()):
+            if shard in self.__restart_at:
+                if now >= self.__restart_at[shard]:
+                    del self.__restart_at[shard]
+                    self.__restarts[shard] += 1
+                    self.__spawn(shard)
+                continue
+
+            if process.is_alive():
+                continue
+
+            # Il backoff cresce solo se il processo cade subito dopo ogni riavvio
+            self.__failures[shard] = 0 if now - started_at >= SHARD_STABLE_TIME else self.__failures[shard] + 1
+            delay = reconnect_delay(self.__failures[shard])
+            logger.warning("Shard %d (pid %s) exited with code %s, restarting in %.1f s", shard, process.pid, process.exitcode, delay)
+            self.__restart_at[shard] = now + delay
+
+    def __drain(self):
+        logger.info("Draining %d shards", len(self.__shards))
+        for process, stop_event, _ in self.__shards.values():
+            stop_event.set()
+
+        deadline = time.monotonic() + SHARD_DRAIN_TIMEOUT
+        for shard, (process, _, _) in self.__shards.items():
+            # Le statistiche vanno lette durante l'attesa: un figlio non termina finché la coda non è svuotata
+            while process.is_alive() and time.monotonic() < deadline:
+                process.join(SUPERVISOR_POLL_INTERVAL)
+                self.__collect_stats()
+            if process.is_alive():
+                logger.warning("Shard %d (pid %s) did not drain in time, terminating", shard, process.pid)
+                process.terminate()
+                process.join()
+
+        self.__collect_stats()
+        self.__shards.clear()
+        self.__restart_at.clear()
+
+    def __collect_stats(self):
+        while True:
+            try:
+                shard, pid, stats = self.__stats_queue.get_nowait()
+            except queue_module.Empty:
+                return
+            self.__stats[shard] = {"pid": pid, **stats}
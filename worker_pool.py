@@ -0,0 +1,174 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from core.amqp.base.log import get_logger
+from core.amqp.settings_decoder import settings_digest
+
+logger = get_logger(__name__)
+
+# Secondi di inattività dopo i quali un worker del pool viene chiuso
+WORKER_IDLE_TIMEOUT = 300
+# Numero massimo di worker inattivi mantenuti per ciascuna identità
+WORKER_MAX_IDLE_PER_KEY = 4
+
+
+def settings_identity(value, excluded_fields: frozenset = frozenset()) -> bytes:
+    """
+    Impronta del contenuto di un oggetto settings, esclusi i campi che non identificano la risorsa
+    (ad esempio il contenuto di SAVE_FILE).
+    """
+    fields = vars(value) if hasattr(value, "__dict__") else value
+    if isinstance(fields, dict):
+        fields = {field: item for field, item in fields.items() if field not in excluded_fields}
+    return settings_digest(fields)
+
+
+class AMQPWorkerPool:
+    """
+    Pool di worker riutilizzabili tra le richieste, indicizzati per classe e identità dei settings.
+
+    L'identità è il contenuto dei settings indicati in identity_keys (ad esempio smtp_settings
+    per SendMailWorker, file_settings senza il contenuto per i worker dei file): richieste con
+    lo stesso server SMTP riusano lo stesso worker e la sua connessione.
+
+    Un worker riutilizzato riceve i settings della nuova richiesta con update_settings(settings),
+    se lo definisce, altrimenti tramite l'attributo settings. Indicando identity_keys il chiamante
+    garantisce che lo stato costruito dal worker dipenda solo da quei settings (ad esempio la
+    connessione SMTP di SendMailWorker): worker con la stessa identità sono quindi intercambiabili.
+    I worker senza identity_keys né update_settings sono creati per ogni richiesta.
+    I worker possono inoltre definire, se servono:
+    - health_check(): restituisce False se il worker non è più riutilizzabile
+    - close(): rilascia le risorse quando il worker esce dal pool
+    """
+
+    def __init__(self, idle_timeout: float = WORKER_IDLE_TIMEOUT, max_idle_per_key: int = WORKER_MAX_IDLE_PER_KEY):
+        self.idle_timeout = idle_timeout
+        self.max_idle_per_key = max_idle_per_key
+
+        self.__lock = threading.Lock()
+        self.__idle = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def acquire(self, worker_class: type, settings: dict, identity_keys: tuple = (), excluded_fields: tuple = ()):
+        """
+        :param identity_keys: Settings che identificano il worker riutilizzabile.
+        :param excluded_fields: Campi dei settings di identity_keys ignorati nel confronto.
+        """
+        if not identity_keys and not callable(getattr(worker_class, "update_settings", None)):
+            worker = worker_class(settings=settings)
+            try:
+                yield worker
+            finally:
+                self.__close([worker])
+            return
+
+        excluded_fields = frozenset(excluded_fields)
+        key = (worker_class, tuple(settings_identity(settings.get(name), excluded_fields) for name in identity_keys))
+
+        worker = self.__checkout(key, settings)
+        if worker is None:
+            worker = worker_class(settings=settings)
+
+        try:
+            yield worker
+        except Exception:
+            # Dopo un errore lo stato delle connessioni del worker non è affidabile
+            self.__close([worker])
+            raise
+        else:
+            self.__checkin(key, worker)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "idle": sum(len(idle) for idle in self.__idle.values())
+            }
+
+    def close(self):
+        with self.__lock:
+            workers = [worker for idle in self.__idle.values() for worker, _ in idle]
+            self.__idle.clear()
+        self.__close(workers)
+
+    def __checkout(self, key: tuple, settings: dict):
+        with self.__lock:
+            expired = self.__pop_expired(time.monotonic())
+        self.__close(expired)
+
+        while True:
+            with self.__lock:
+                idle = self.__idle.get(key)
+                if not idle:
+                    self.misses += 1
+                    return None
+                worker, _ = idle.pop()
+
+            # Il controllo può fare I/O (ad esempio un NOOP SMTP), quindi è eseguito fuori dal lock
+            if self.__is_healthy(worker):
+                with self.__lock:
+                    self.hits += 1
+                self.__update_settings(worker, settings)
+                return worker
+
+            self.__close([worker])
+
+    def __checkin(self, key: tuple, worker):
+        now = time.monotonic()
+        with self.__lock:
+            expired = self.__pop_expired(now)
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_key:
+                idle.append((worker, now))
+            else:
+                expired.append(worker)
+
+        self.__close(expired)
+
+    def __pop_expired(self, now: float) -> list:
+        # Da chiamare con il lock acquisito
+        expired = []
+        for key in list(self.__idle):
+            idle = self.__idle[key]
+            alive = [(worker, last_used) for worker, last_used in idle if now - last_used < self.idle_timeout]
+            expired.extend(worker for worker, last_used in idle if now - last_used >= self.idle_timeout)
+            if alive:
+                self.__idle[key] = alive
+            else:
+                del self.__idle[key]
+        self.evictions += len(expired)
+        return expired
+
+    def __update_settings(self, worker, settings: dict):
+        update_settings = getattr(worker, "update_settings", None)
+        if callable(update_settings):
+            update_settings(settings)
+        else:
+            worker.settings = settings
+
+    def __is_healthy(self, worker) -> bool:
+        health_check = getattr(worker, "health_check", None)
+        if health_check is None:
+            return True
+        try:
+            return bool(health_check())
+        except Exception as e:
+            logger.warning("Health check of %s failed: %s", type(worker).__name__, e)
+            return False
+
+    def __close(self, workers: list):
+        for worker in workers:
+            close = getattr(worker, "close", None)
+            if close is None:
+                continue
+            try:
+                close()
+            except Exception as e:
+                logger.warning("Impossibile chiudere %s: %s", type(worker).__name__, e)